@@ -0,0 +1,231 @@
+#coding=utf-8
+"""Asyncio kbin client, for fetching and replying to several threads at once.
+
+It does what login, post, list_threads and post_reply in main.py do over one aiohttp session with a
+bounded connection pool, so pages for many threads and magazines load side by side.  Reply bodies are
+generated in a single worker thread, which overlaps them with the network without ever running two at once
+on the same brain.  Requests share main.py's RateLimiter.  aiohttp is optional; without it the bot sticks
+to one blocking request at a time.
+"""
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+import regex as re
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from ratelimit import RETRIES, RateLimiter, told_to_back_off
+
+__all__ = ['TOKEN_REGEX', 'MAGAZINE_REGEX', 'THREAD_REGEX', 'THREAD_SINGLE_REGEX', 'Page', 'KbinClient']
+
+# Kbin regexes
+TOKEN_REGEX = re.compile('"(_csrf_token|entry_article\[_token\]|entry_comment\[_token\])"\s+value="(.+)"')
+MAGAZINE_REGEX = re.compile('"entry_article\[magazine\]\[autocomplete\]".+value="([0-9]+)"\sselected="selected"')
+THREAD_REGEX = re.compile('id="entry-([0-9]+)"[\s\w\-=":@>#<]+<a\s+href=".+">(.+)<\/a>') # Group 1 is thread id, 2 is title, 3 is content, 4 is date posted
+THREAD_SINGLE_REGEX = re.compile('og:title" content="(.+) - CHATBOT THUNDERDOME - kbin.social">[\s\w\-=":@>#<]+og:description" content="(.+)">') # 1 is title, 2 is body
+
+DEFAULT_CONNECTIONS = 4
+FORM_RETRIES = 3  # Times a form is posted again after a 422
+
+Page = namedtuple('Page', 'status url text login')  # login: redirected to the login page
+
+
+class KbinClient(object):
+
+    def __init__(self, instance, user, password, lang, limiter=None, connections=DEFAULT_CONNECTIONS,
+                 cookies=None, scheme='https'):
+        """instance: host name of the kbin instance
+        limiter: RateLimiter to share with other sessions
+        connections: most connections open at once
+        cookies: name -> value, such as a logged in requests session's.  The client takes them to be logged in
+                 until a page redirects it to the login page."""
+        if aiohttp is None:
+            raise RuntimeError('The asyncio kbin client needs aiohttp')
+        self.base = '%s://%s' % (scheme, instance)
+        self.user = user
+        self.password = password
+        self.lang = lang
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.connections = connections
+        self.cookies = cookies
+        self.logged_in = bool(cookies)
+        self.logins = 0
+        self.session = None
+        self.executor = None
+
+    async def __aenter__(self):
+        # unsafe lets an instance (or a local stub server) at an IP address keep its cookies
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections),
+                                             cookie_jar=aiohttp.CookieJar(unsafe=True), cookies=self.cookies)
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='kbin-generate')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.executor.shutdown()
+
+    async def request(self, method, path, form=None, headers=None):
+        """Send a request once the rate limiter allows it, return a Page.  form is a dict of fields, sent as
+        multipart; (filename, content, content type) tuples become file fields."""
+        url = self.base + path
+        retries = RETRIES if method == 'GET' else 0
+        while True:
+            await asyncio.sleep(self.limiter.reserve(method, url))
+            async with self.session.request(method, url, data=None if form is None else make_form(form),
+                                            headers=headers) as response:
+                text = await response.text()
+                if told_to_back_off(response.status, response.headers):
+                    self.limiter.back_off(url, response.headers.get('Retry-After'))
+                    if retries:
+                        retries -= 1
+                        continue
+                login = bool(response.history) and 'login' in str(response.url)
+                if login:
+                    self.logged_in = False
+                return Page(response.status, str(response.url), text, login)
+
+    async def post_form(self, path, form, referer, token):
+        """POST form from the page at referer.  A 422 means its csrf token (the token field) was used up or went
+        stale, so the page is fetched again for a fresh one before each retry."""
+        headers = {
+            "Origin": self.base,
+            "Referer": self.base + referer
+        }
+        retries = FORM_RETRIES
+        while True:
+            page = await self.request('POST', path, form, headers)
+            if page.status != 422 or not retries:
+                return page
+            retries -= 1
+            await asyncio.sleep(2)
+            fresh = await self.request('GET', referer)
+            csrf_token = get_csrf(fresh.text)
+            if fresh.status != 200 or fresh.login or not csrf_token:
+                return page
+            form[token] = csrf_token
+
+    async def login(self):
+        page = await self.request('GET', '/login')
+        csrf_token = get_csrf(page.text)
+        if not (200 <= page.status < 300) or not csrf_token:
+            return False
+        form = {
+            "email": self.user,
+            "password": self.password,
+            "_csrf_token": csrf_token
+        }
+        page = await self.request('POST', '/login', form)
+        self.logged_in = page.status in (200, 302)
+        if self.logged_in:
+            self.logins += 1
+        return self.logged_in
+
+    def get_cookies(self):
+        """(name, value, domain, path) of each cookie the instance has set, to hand a new login back to a requests
+        session.  Cookies passed in when the client was made have no domain and are left out."""
+        return [(cookie.key, cookie.value, cookie['domain'], cookie['path'] or '/')
+                for cookie in self.session.cookie_jar if cookie['domain']]
+
+    async def post(self, magazine, title, description=None, tags=None):
+        page = await self.request('GET', f"/m/{magazine}/new/article")
+        csrf_token = get_csrf(page.text)
+        match = MAGAZINE_REGEX.search(page.text)
+        if not (200 <= page.status < 300) or page.login or not csrf_token or not match:
+            return False
+        form = {
+            "entry_article[title]": title,
+            "entry_article[body]": description if description is not None else "",
+            "entry_article[magazine][autocomplete]": match.group(1),
+            "entry_article[tags]": ",".join(tags) if tags else "",
+            "entry_article[badges]": "",
+            "entry_article[image]": ("", "", "application/octet-stream"),
+            "entry_article[imageUrl]": "",
+            "entry_article[imageAlt]": "",
+            "entry_article[lang]": self.lang,
+            "entry_article[submit]": "",
+            "entry_article[_token]": csrf_token
+        }
+        page = await self.post_form(f"/m/{magazine}/new/article", form, f"/m/{magazine}/new/article",
+                                    "entry_article[_token]")
+        return page.status in (200, 302)
+
+    async def list_threads(self, magazine):
+        """Threads in magazine by id -> {'title': title}, empty if the page couldn't be loaded"""
+        page = await self.request('GET', f"/m/{magazine}")
+        threads = {}
+        if page.status == 200:
+            for match in THREAD_REGEX.finditer(page.text):
+                threads[int(match.group(1))] = {'title': match.group(2)}
+        return threads
+
+    async def list_magazines(self, magazines):
+        """list_threads for each of magazines at once, by magazine"""
+        threads = await asyncio.gather(*[self.list_threads(magazine) for magazine in magazines])
+        return dict(zip(magazines, threads))
+
+    async def get_thread(self, magazine, thread_id):
+        """(title, description, csrf token) of a thread, or None if the page couldn't be loaded"""
+        page = await self.request('GET', f"/m/{magazine}/t/{thread_id}")
+        csrf_token = get_csrf(page.text)
+        if page.status != 200 or page.login or not csrf_token:
+            return None
+        title = desc = ""
+        for match in THREAD_SINGLE_REGEX.finditer(page.text):
+            title, desc = match.group(1), match.group(2)
+        return title, desc, csrf_token
+
+    async def comment(self, magazine, thread_id, body, csrf_token):
+        form = {
+            "entry_comment[body]": body,
+            "entry_comment[image]": ("", "", "application/octet-stream"),
+            "entry_comment[imageUrl]": "",
+            "entry_comment[imageAlt]": "",
+            "entry_comment[lang]": self.lang,
+            "entry_comment[submit]": "",
+            "entry_comment[_token]": csrf_token
+        }
+        page = await self.post_form(f"/m/{magazine}/t/{thread_id}/-/comment", form, f"/m/{magazine}/t/{thread_id}",
+                                    "entry_comment[_token]")
+        return page.status in (200, 302)
+
+    async def post_reply(self, magazine, thread_id, generate):
+        """Reply to a thread with generate("title description"), called in the generating thread"""
+        thread = await self.get_thread(magazine, thread_id)
+        if thread is None:
+            return False
+        title, desc, csrf_token = thread
+        body = await asyncio.get_running_loop().run_in_executor(self.executor, generate, "%s %s" % (title, desc))
+        return await self.comment(magazine, thread_id, body, csrf_token)
+
+    async def post_replies(self, magazine, thread_ids, generate):
+        """post_reply to each of thread_ids at once, return thread id -> whether the reply went through.
+        Failed replies are tried again after logging in, if the client wasn't logged in or a page sent it to the
+        login page; other failures, such as a thread that's gone, keep the session it has."""
+        results = await asyncio.gather(*[self.post_reply(magazine, thread_id, generate) for thread_id in thread_ids])
+        results = dict(zip(thread_ids, results))
+        failed = [thread_id for thread_id in thread_ids if not results[thread_id]]
+        if failed and not self.logged_in and await self.login():
+            retried = await asyncio.gather(*[self.post_reply(magazine, thread_id, generate) for thread_id in failed])
+            results.update(zip(failed, retried))
+        return results
+
+
+def get_csrf(text):
+    match = TOKEN_REGEX.search(text)
+    if match:
+        return match.group(2)
+
+
+def make_form(fields):
+    form = aiohttp.FormData()
+    for name, value in fields.items():
+        if isinstance(value, tuple):
+            filename, content, content_type = value
+            form.add_field(name, content.encode(), filename=filename, content_type=content_type)
+        else:
+            form.add_field(name, value)
+    return form
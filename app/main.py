@@ -11,17 +11,21 @@ import traceback
 import random
 import string
 import math
+import asyncio
 from time import sleep, time
 from datetime import datetime, timedelta
 from dateutil.parser import *
 from dateutil.tz import tzutc
 from dotenv import load_dotenv
 #from rss_parser import Parser as RSSParser
-from typing import Optional, List, Dict, Union
+from typing import Optional, List, Dict, Tuple, Union
 import logging
 
 # megahal
 from megahal import *
+from replypool import ReplyPool
+from ratelimit import DEFAULT_BUDGETS, RateLimiter, RateLimitedSession
+from kbinclient import TOKEN_REGEX, MAGAZINE_REGEX, THREAD_REGEX, THREAD_SINGLE_REGEX, KbinClient, aiohttp
 
 # text/nlp parsing
 from html.parser import HTMLParser
@@ -40,12 +44,6 @@ logging.basicConfig(filename=KBOT_STDERR)
 logger = logging.getLogger("kbot")
 logger.setLevel(logging._nameToLevel[KBOT_LOGLEVEL])
 
-# Kbin regexes
-TOKEN_REGEX = re.compile('"(_csrf_token|entry_article\[_token\]|entry_comment\[_token\])"\s+value="(.+)"')
-MAGAZINE_REGEX = re.compile('"entry_article\[magazine\]\[autocomplete\]".+value="([0-9]+)"\sselected="selected"')
-THREAD_REGEX = re.compile('id="entry-([0-9]+)"[\s\w\-=":@>#<]+<a\s+href=".+">(.+)<\/a>') # Group 1 is thread id, 2 is title, 3 is content, 4 is date posted
-THREAD_SINGLE_REGEX = re.compile('og:title" content="(.+) - CHATBOT THUNDERDOME - kbin.social">[\s\w\-=":@>#<]+og:description" content="(.+)">') # 1 is title, 2 is body
-
 # env stuff
 KBOT_USER = os.getenv("KBOT_USER")
 KBOT_PASS = os.getenv("KBOT_PASS")
@@ -56,12 +54,28 @@ KBOT_LANG = os.getenv("KBOT_LANG")
 
 KBOT_FREQUENCY = max(120, int(os.getenv("KBOT_FREQUENCY", "600")))
 KBOT_THREAD_CACHE_SECONDS = max(10, int(os.getenv("KBOT_THREAD_CACHE_SECONDS", "30")))
+KBOT_THREAD_PAGES = max(1, int(os.getenv("KBOT_THREAD_PAGES", "1"))) # Pages of the magazine listing to pick threads from
+KBOT_THREAD_INDEX = os.getenv("KBOT_THREAD_INDEX", ".hal-kbot-threads.json") # Where the thread listing is kept between runs
+KBOT_TOKEN_CACHE_SECONDS = max(0, int(os.getenv("KBOT_TOKEN_CACHE_SECONDS", "1800"))) # How long a scraped csrf token is reused; 0 scrapes one for every form
+KBOT_BRAIN_STORE = os.getenv("KBOT_BRAIN_STORE") or None # "shelve" or "sqlite"; unset means detect from the brain file
+KBOT_WORKERS = max(1, int(os.getenv("KBOT_WORKERS", "1"))) # Processes searching for each reply in parallel
+KBOT_POST_BUDGET = max(1.0, float(os.getenv("KBOT_POST_BUDGET", "5"))) # Seconds of reply search shared by one post's title and body
+KBOT_REPLY_POOL = max(0, int(os.getenv("KBOT_REPLY_POOL", "8"))) # Replies per prompt searched for ahead of time; 0 turns the pool off
+KBOT_TRAIN_CHECKPOINT = max(100, int(os.getenv("KBOT_TRAIN_CHECKPOINT", "10000"))) # Lines trained between saves of the brain
+KBOT_SNAPSHOT = os.getenv("KBOT_SNAPSHOT") or None # Brain snapshot (from `megahal --export`) to start from instead of the brain file
+KBOT_COMPACT_HOURS = max(0.0, float(os.getenv("KBOT_COMPACT_HOURS", "0"))) # How often to prune and rewrite the brain; 0 never does
+KBOT_COMPACT_MIN_COUNT = max(1, int(os.getenv("KBOT_COMPACT_MIN_COUNT", "2"))) # Contexts seen fewer times than this get pruned
+KBOT_RATE_PAGES = max(0.01, float(os.getenv("KBOT_RATE_PAGES", "1"))) # Page loads per second allowed once a burst is used up
+KBOT_RATE_FORMS = max(0.01, float(os.getenv("KBOT_RATE_FORMS", "0.2"))) # Form posts per second, likewise
+KBOT_REPLIES = max(1, int(os.getenv("KBOT_REPLIES", "1"))) # Threads replied to each cycle; more than 1 fetches and posts them all at once (needs aiohttp)
+KBOT_CONNECTIONS = max(1, int(os.getenv("KBOT_CONNECTIONS", "4"))) # Connections open at once when replying to several threads
 
 assert KBOT_USER and KBOT_PASS and KBOT_INSTANCE and KBOT_MAGAZINE and KBOT_LANG, "Environment not set up correctly!"
 
 # MegaHAL brain stuff
 DEFAULT_BRAINFILE = '.hal-kbot-brain' #os.path.join(os.environ.get('HOME', ''), '.pymegahal-brain')
 DEFAULT_TRAINER = 'lolstodon.trainer'
+DEFAULT_SNAPSHOT = DEFAULT_BRAINFILE + '.snap' # Exported for --offline/--nolearn when KBOT_SNAPSHOT isn't set
 # DEFAULT_CACHEFILE = '.hal-kbot-cache'
 
 hellos = [  # These are used to add variety to the bot's responses in case it gets stuck.
@@ -73,6 +87,23 @@ hellos = [  # These are used to add variety to the bot's responses in case it ge
     "tu fais quoi ce soir?","was passiert jetzt?","was ist jetzt los?","qu'est-ce qui se passe?"
     ]
 
+quotes = [  # Same idea as hellos, but longer.
+    "The sun is a mass of incandescent gas, a gigantic nuclear furnace where hydrogen is built into helium at a temperature of millions of degrees.",
+    "You only live once, but if you do it right, once is enough.",
+    "If you tell the truth, you don't have to remember anything.",
+    "I am so clever that sometimes I don't understand a single word of what I am saying.",
+    "Pardon me, but do you have any Grey Poupon?",
+    "What is the airspeed velocity of an unladen swallow?",
+    "I ask you, what do you really think of me?",
+    "Let any fish who meets my gaze learn the true meaning of fear; for I am the harbinger of death.",
+    "The other day I was talking with my neighbours and they mentioned hearing weird noises.",
+    "The legend tells that a long time ago all seawater was fresh.",
+    "I’ll have you know I graduated top of my class in the Navy Seals.",
+    "According to all known laws of aviation, there is no way that a bee should be able to fly.",
+    "The running speed starts slowly, but gets faster each minute after you hear this signal.",
+    "Did you ever hear the tragedy of Darth Plagueis The Wise?"
+    ]
+
 cache_name = ".last-updated"
 logged_in = False
 
@@ -141,34 +172,54 @@ def login_hook(r: requests.Response, *args, **kwargs):
     if r.history and "login" in r.url:
         log("info",f"Redirected to login page: {r.status_code} {r.url}")
         logged_in = False
+        forget_tokens() # They belonged to the session that just ended
 
 
-def rate_limit_hook(r: requests.Response, *args, **kwargs):
-    global last_request_time
-    poll_latency = 1.0
-
-    now = time()
-    if now < poll_latency + last_request_time:
-        sleep(min(poll_latency, poll_latency + last_request_time > now))
-    last_request_time = time()
-
 def get_session():
-    global last_request_time
-
-    last_request_time = time() - 100
-    session = requests.Session()
-    session.hooks['response'].append(rate_limit_hook)
+    limiter = RateLimiter({
+        'page': (KBOT_RATE_PAGES, DEFAULT_BUDGETS['page'][1]),
+        'form': (KBOT_RATE_FORMS, DEFAULT_BUDGETS['form'][1])
+    })
+    session = RateLimitedSession(limiter) # Waits before each request, and backs off when the instance says so
     session.hooks['response'].append(login_hook)
     return session
 
 kbin_session = get_session()
 
+###
+# CSRF tokens scraped from form pages, by form field ("entry_article[_token]", "entry_comment[_token]", ...):
+#    - "cached_at" -> datetime
+#    - "token" -> str
+# Tokens belong to kbin_session's login, so logging in again, being sent to the login page or a 422 from
+# the form throws them away.  Magazine ids and thread texts never change, so they are kept for good.
+#
+cached_tokens: Dict[str, Dict[str, Union[datetime, str]]] = {}
+TOKEN_CACHE_TIMEOUT = timedelta(seconds=KBOT_TOKEN_CACHE_SECONDS)
+magazine_ids: Dict[str, int] = {}
+thread_texts: Dict[int, Tuple[str, str]] = {} # Thread id -> (title, description)
+
+def get_cached_token(form: str) -> Optional[str]:
+    if form in cached_tokens and (datetime.utcnow() - cached_tokens[form]["cached_at"]) < TOKEN_CACHE_TIMEOUT:
+        return cached_tokens[form]["token"]
+    return None
+
+def forget_tokens(form: Optional[str] = None):
+    if form is None:
+        cached_tokens.clear()
+    else:
+        cached_tokens.pop(form, None)
+
 def get_csrf(response: requests.Response) -> Optional[str]:
-    match = TOKEN_REGEX.search(response.text)
-    if not match:
+    token = None
+    for match in TOKEN_REGEX.finditer(response.text):
+        cached_tokens[match.group(1)] = {
+            "cached_at": datetime.utcnow(),
+            "token": match.group(2)
+        }
+        token = token or match.group(2)
+    if not token:
         log("error","Could not find csrf token!")
-        return None
-    return match.group(2)
+    return token
 
 def login() -> bool:
     global logged_in
@@ -193,6 +244,7 @@ def login() -> bool:
         log("error",f"Unexpected status code: {response.status_code}")
         return False
 
+    forget_tokens() # New session, new tokens
     logged_in = True
     return True
 
@@ -204,54 +256,61 @@ def get_magazine(response: requests.Response) -> int:
     return int(match.group(1))
 
 def post(title: str, description: str = None, tags: Optional[List[str]] = None) -> bool:
-    response = kbin_session.get(f"https://{KBOT_INSTANCE}/m/{KBOT_MAGAZINE}/new/article")
-    if(not (200 <= response.status_code < 300)):
-        log("error",f"Unexpected status code: {response.status_code}")
-        return False
-    
-    _csrf_token = get_csrf(response)
-
-    if not _csrf_token:
-        return False
-    
-    magazine_id = get_magazine(response)
-
-    if magazine_id == -1:
-        return False
-
-    form_data = {
-        "entry_article[title]": title,
-        "entry_article[body]": description if description is not None else "",
-        "entry_article[magazine][autocomplete]": str(magazine_id),
-        "entry_article[tags]": ",".join(tags) if tags else "",
-        "entry_article[badges]": "",
-        "entry_article[image]": ("", "", "application/octet-stream"),
-        "entry_article[imageUrl]": "",
-        "entry_article[imageAlt]": "",
-        "entry_article[lang]": KBOT_LANG,
-        "entry_article[submit]": "",
-        "entry_article[_token]": _csrf_token
-    }
-
-    m = MultipartEncoder(
-        fields=form_data
-    )
-
-    headers = {
-        "Content-Type": m.content_type,
-        "Origin": f"https://{KBOT_INSTANCE}",
-        "Referer": f"https://{KBOT_INSTANCE}/m/{KBOT_MAGAZINE}/new/article"
-    }
-
     retries = 3
-    status = 422
-    while status == 422 and retries > 0:
+    while True:
+        # The form page is only needed for what isn't cached
+        _csrf_token = get_cached_token("entry_article[_token]")
+        magazine_id = magazine_ids.get(KBOT_MAGAZINE, -1)
+        if _csrf_token is None or magazine_id == -1:
+            response = kbin_session.get(f"https://{KBOT_INSTANCE}/m/{KBOT_MAGAZINE}/new/article")
+            if(not (200 <= response.status_code < 300)):
+                log("error",f"Unexpected status code: {response.status_code}")
+                return False
+
+            _csrf_token = get_csrf(response)
+
+            if not _csrf_token:
+                return False
+
+            magazine_id = get_magazine(response)
+
+            if magazine_id == -1:
+                return False
+            magazine_ids[KBOT_MAGAZINE] = magazine_id
+
+        form_data = {
+            "entry_article[title]": title,
+            "entry_article[body]": description if description is not None else "",
+            "entry_article[magazine][autocomplete]": str(magazine_id),
+            "entry_article[tags]": ",".join(tags) if tags else "",
+            "entry_article[badges]": "",
+            "entry_article[image]": ("", "", "application/octet-stream"),
+            "entry_article[imageUrl]": "",
+            "entry_article[imageAlt]": "",
+            "entry_article[lang]": KBOT_LANG,
+            "entry_article[submit]": "",
+            "entry_article[_token]": _csrf_token
+        }
+
+        m = MultipartEncoder(
+            fields=form_data
+        )
+
+        headers = {
+            "Content-Type": m.content_type,
+            "Origin": f"https://{KBOT_INSTANCE}",
+            "Referer": f"https://{KBOT_INSTANCE}/m/{KBOT_MAGAZINE}/new/article"
+        }
+
         response = kbin_session.post(f"https://{KBOT_INSTANCE}/m/{KBOT_MAGAZINE}/new/article", data=m, headers=headers)
-        status = response.status_code
-        if status == 422:
-            retries -= 1
-            log("debug",f"Auto retrying after delay due to 422 error... ({retries} left)")
-            sleep(2)
+        if response.status_code != 422:
+            break
+        forget_tokens("entry_article[_token]") # Probably stale, scrape a fresh one
+        retries -= 1
+        if not retries:
+            break
+        log("debug",f"Auto retrying after delay due to 422 error... ({retries} left)")
+        sleep(2)
     
     if(response.status_code not in [200, 302]):
         log("error",f"Unexpected status code: {response.status_code} - {response.url}")
@@ -267,24 +326,94 @@ def post(title: str, description: str = None, tags: Optional[List[str]] = None)
 cached_threads: Dict[str, Dict[str, Union[datetime, Dict[int, str]]]] = {}
 THREAD_CACHE_TIMEOUT = timedelta(seconds=KBOT_THREAD_CACHE_SECONDS)
 
-# Lists threads in magazine by id -> title
+###
+# Thread index, saved to KBOT_THREAD_INDEX so it outlives restarts.  By magazine:
+#    - "pages" -> listing page number -> {"etag", "last_modified", "ids"}
+#    - "threads" -> thread id -> {"title", "first_seen", "last_seen"}
+# Listing pages are requested with If-None-Match/If-Modified-Since, so a page that hasn't changed costs a
+# 304 and no parsing.  Threads that haven't been listed for THREAD_INDEX_DAYS are dropped.
+#
+THREAD_INDEX_DAYS = 30
+thread_index: Optional[Dict[str, Dict[str, Dict[str, Dict]]]] = None
+
+def get_thread_index() -> Dict[str, Dict[str, Dict[str, Dict]]]:
+    global thread_index
+    if thread_index is None:
+        thread_index = {}
+        if os.path.exists(KBOT_THREAD_INDEX):
+            try:
+                with open(KBOT_THREAD_INDEX) as f:
+                    thread_index = json.load(f)
+            except Exception as e:
+                log("error",f"Got exception while reading the thread index, starting a new one: {e}")
+    return thread_index
+
+def save_thread_index():
+    cutoff = (datetime.utcnow() - timedelta(days=THREAD_INDEX_DAYS)).replace(tzinfo=tzutc()).isoformat()
+    for index in thread_index.values():
+        for thread_id in [thread_id for thread_id, thread in index["threads"].items() if thread["last_seen"] < cutoff]:
+            del index["threads"][thread_id]
+        # A page listing a dropped thread has to be fetched in full again, so forget its ETag too
+        for page in [page for page, listed in index["pages"].items() if any(thread_id not in index["threads"] for thread_id in listed["ids"])]:
+            del index["pages"][page]
+    try:
+        with open(f"{KBOT_THREAD_INDEX}.tmp", "w") as f:
+            json.dump(thread_index, f)
+        os.replace(f"{KBOT_THREAD_INDEX}.tmp", KBOT_THREAD_INDEX)
+    except Exception as e:
+        log("error",f"Got exception while writing the thread index: {e}")
+
+# Lists threads in magazine by id -> title, from the first KBOT_THREAD_PAGES pages of its listing
 # Caches threads automatically for 10 to infinite seconds, configurable with .env KBOT_THREAD_CACHE_SECONDS
 def list_threads(magazine: str, invalidate_cache: bool = False) -> Dict[int, str]:
     global cached_threads
     if not invalidate_cache and magazine in cached_threads and (datetime.utcnow() - cached_threads[magazine]["cached_at"]) < THREAD_CACHE_TIMEOUT:
         return cached_threads[magazine]["threads"]
+    index = get_thread_index().setdefault(magazine, {"pages": {}, "threads": {}})
+    now = datetime.utcnow().replace(tzinfo=tzutc()).isoformat()
     to_return = {}
-    response = kbin_session.get(f"https://{KBOT_INSTANCE}/m/{magazine}")
-    if response.status_code != 200:
-        log("error",f"Got unexpected status while retrieving threads: {response.status_code}")
+    for page in range(1, KBOT_THREAD_PAGES + 1):
+        listed = index["pages"].get(str(page))
+        if listed and not all(thread_id in index["threads"] for thread_id in listed["ids"]):
+            listed = None # An index saved before pages were pruned along with threads, a 304 wouldn't give us every title
+        headers = {}
+        if listed and not invalidate_cache:
+            if listed["etag"]:
+                headers["If-None-Match"] = listed["etag"]
+            if listed["last_modified"]:
+                headers["If-Modified-Since"] = listed["last_modified"]
+        response = kbin_session.get(f"https://{KBOT_INSTANCE}/m/{magazine}" + (f"?p={page}" if page > 1 else ""), headers=headers)
+        if response.status_code == 304 and listed:
+            ids = listed["ids"] # Nothing new on this page
+        elif response.status_code == 200 and not (response.history and "login" in response.url):
+            ids = []
+            matches: List[re.Match[str]] = THREAD_REGEX.finditer(response.text)
+            for match in matches:
+                thread_id = match.group(1)
+                title = match.group(2)
+                #content = match.group(3)
+                #date = match.group(4)
+                index["threads"].setdefault(thread_id, {"first_seen": now})["title"] = title
+                ids.append(thread_id)
+            index["pages"][str(page)] = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "ids": ids
+            }
+        elif page > 1 and response.status_code == 404:
+            break # Past the last page
+        else:
+            log("error",f"Got unexpected status while retrieving threads: {response.status_code}")
+            break
+        for thread_id in ids:
+            index["threads"][thread_id]["last_seen"] = now
+            to_return[int(thread_id)] = {'title':index["threads"][thread_id]["title"]} #, 'content':content, 'date':date}
+        if not ids:
+            break # Past the last page
+
+    if not to_return:
         return to_return
-    matches: List[re.Match[str]] = THREAD_REGEX.finditer(response.text)
-    for match in matches:
-        thread_id = int(match.group(1))
-        title = match.group(2)
-        #content = match.group(3)
-        #date = match.group(4)
-        to_return[thread_id] = {'title':title } #, 'content':content, 'date':date}
+    save_thread_index()
 
     cached_threads[magazine] = {
         "cached_at": datetime.utcnow(),
@@ -294,54 +423,76 @@ def list_threads(magazine: str, invalidate_cache: bool = False) -> Dict[int, str
     log("debug","to_return: %s" % to_return)
     return to_return
 
-def post_reply(bot, magazine: str, thread_id: int) -> bool:
+def get_thread(magazine: str, thread_id: int) -> Optional[Tuple[str, str]]:
+    "Title and description of a thread, with its page scraped for a comment token too."
     response = kbin_session.get(f"https://{KBOT_INSTANCE}/m/{magazine}/t/{thread_id}")
-    if response.status_code != 200:
+    if response.status_code != 200 or (response.history and "login" in response.url):
         log("error",f"Unexpected status code while retrieving thread: {response.status_code}")
-        return False
-    
-    csrf_token = get_csrf(response)
-    if csrf_token is None:
+        return None
+
+    if get_csrf(response) is None:
         log("error","Could not find csrf_token while posting comment!")
-        return False
-    
-    
+        return None
+
+    title = desc = ""
     matches: List[re.Match[str]] = THREAD_SINGLE_REGEX.finditer(response.text)
     for match in matches:
         title = match.group(1)
         desc = match.group(2)
+        thread_texts[thread_id] = (title, desc)
+    return title, desc
 
-    body = generate_body(bot, "%s %s" % (title, desc))
+def post_reply(bot, magazine: str, thread_id: int, learn: bool = True) -> bool:
+    # A thread replied to before, with a comment token still fresh, needs no page load
+    thread = thread_texts.get(thread_id)
+    if thread is None or get_cached_token("entry_comment[_token]") is None:
+        thread = get_thread(magazine, thread_id)
+        if thread is None:
+            return False
+    title, desc = thread
 
-    form_data = {
-        "entry_comment[body]": body,
-        "entry_comment[image]": ("", "", "application/octet-stream"),
-        "entry_comment[imageUrl]": "",
-        "entry_comment[imageAlt]": "",
-        "entry_comment[lang]": KBOT_LANG,
-        "entry_comment[submit]": "",
-        "entry_comment[_token]": csrf_token
-    }
-
-    m = MultipartEncoder(fields=form_data)
-
-    headers = {
-        "Content-Type": m.content_type,
-        "Origin": f"https://{KBOT_INSTANCE}",
-        "Referer": f"https://{KBOT_INSTANCE}/m/{magazine}/t/{thread_id}"
-    }
+    body = generate_body(bot, "%s %s" % (title, desc), KBOT_POST_BUDGET, learn)
 
     log("debug",f"Posting reply '{body}'...")
 
     retries = 3
-    status = 422
-    while status == 422 and retries > 0:
+    while True:
+        csrf_token = get_cached_token("entry_comment[_token]")
+        if csrf_token is None:
+            if get_thread(magazine, thread_id) is None:
+                return False
+            csrf_token = get_cached_token("entry_comment[_token]")
+            if csrf_token is None:
+                log("error","Could not find csrf_token while posting comment!")
+                return False
+
+        form_data = {
+            "entry_comment[body]": body,
+            "entry_comment[image]": ("", "", "application/octet-stream"),
+            "entry_comment[imageUrl]": "",
+            "entry_comment[imageAlt]": "",
+            "entry_comment[lang]": KBOT_LANG,
+            "entry_comment[submit]": "",
+            "entry_comment[_token]": csrf_token
+        }
+
+        m = MultipartEncoder(fields=form_data)
+
+        headers = {
+            "Content-Type": m.content_type,
+            "Origin": f"https://{KBOT_INSTANCE}",
+            "Referer": f"https://{KBOT_INSTANCE}/m/{magazine}/t/{thread_id}"
+        }
+
         response = kbin_session.post(f"https://{KBOT_INSTANCE}/m/{magazine}/t/{thread_id}/-/comment", data=m, headers=headers)
-        status = response.status_code
-        if status == 422:
-            retries -= 1
-            log("debug",f"Auto retrying after delay due to 422 error... ({retries} left)")
-            sleep(2)
+        if response.status_code != 422:
+            break
+        forget_tokens("entry_comment[_token]") # Probably stale, scrape a fresh one
+        retries -= 1
+        if not retries:
+            break
+        log("debug",f"Auto retrying after delay due to 422 error... ({retries} left)")
+        sleep(2)
     
     if(response.status_code not in [200, 302]):
         log("error",f"Unexpected status code while adding comment: {response.status_code} - {response.url}")
@@ -349,46 +500,70 @@ def post_reply(bot, magazine: str, thread_id: int) -> bool:
 
     return True
 
-def generate_body(bot, prompt):
-    "Generate body text for posts or comments."
-    if not prompt:
-        prompt = ''
-
+async def post_replies(bot, magazine: str, thread_ids: List[int], learn: bool = True) -> Dict[int, bool]:
+    "Reply to several threads at once, sharing the blocking session's login and rate limits."
+    global logged_in
+    cookies = dict((cookie.name, cookie.value) for cookie in kbin_session.cookies)
+    async with KbinClient(KBOT_INSTANCE, KBOT_USER, KBOT_PASS, KBOT_LANG, kbin_session.limiter, KBOT_CONNECTIONS, cookies) as client:
+        replies = await client.post_replies(magazine, thread_ids, lambda prompt: generate_body(bot, prompt, KBOT_POST_BUDGET, learn))
+        if client.logins:
+            # The client logged in again, so its cookies hold the session now
+            for name, value, domain, path in client.get_cookies():
+                kbin_session.cookies.set(name, value, domain=domain, path=path)
+            forget_tokens() # They belonged to the old session
+            logged_in = True
+        return replies
+
+def compose(bot, fragments, budget, learn=True):
+    """Get distinct replies for each (prompt, count) fragment of a post, all within one deadline.
+    Each fragment gets a share of the remaining budget in proportion to its count. The prompts are
+    learned from unless learn is off."""
+    deadline = time() + budget
+    total = sum(count for prompt, count in fragments)
+    results = []
+    for prompt, count in fragments:
+        share = max(0.0, deadline - time()) * count / total
+        total -= count
+        replies = bot.get_replies(prompt or '', count, timeout=share, learn=learn)
+        while len(replies) < count and time() < deadline: # Not enough different sentences, so get more with different input
+            log("error","[_] Collision: %s" % replies[-1])
+            r = random.choice([1,2])
+            if r == 1: # Say hello
+                extra = bot.get_replies(random.choice(hellos), count - len(replies), timeout=min(share, deadline - time()), learn=learn)
+            if r == 2: # Use a random quote
+                extra = bot.get_replies(random.choice(quotes), count - len(replies), timeout=min(share, deadline - time()), learn=learn)
+            replies.extend(s for s in extra if s not in replies)
+        while len(replies) < count: # Out of time, make do with what we have
+            replies.append(replies[-1])
+        results.append(replies)
+    return results
+
+def splice_title(s1, s2):
+    "Splice two replies into a post title."
     # At which fraction should we splice the replies?
     frac = random.choice([0.2,0.25,0.3,0.35,0.35,0.4,0.4,0.4])
-    # Get two replies and splice them together, for extra variety
-    s3 = bot.get_reply(prompt)
-    s4 = bot.get_reply(prompt)
-    while (s3 == s4): # We got the same sentence twice, so get a new reply with different input
-        log("error","[_] Collision: %s" % s4)
-        r = random.choice([1,2])
-        if r == 1: # Say hello
-            s4 = bot.get_reply(random.choice(hellos))
-        if r == 2: # Use a random quote
-            s4 = bot.get_reply(random.choice(["The sun is a mass of incandescent gas, a gigantic nuclear furnace where hydrogen is built into helium at a temperature of millions of degrees.",
-                                              "You only live once, but if you do it right, once is enough.",
-                                              "If you tell the truth, you don't have to remember anything.",
-                                              "I am so clever that sometimes I don't understand a single word of what I am saying.",
-                                              "Pardon me, but do you have any Grey Poupon?",
-                                              "What is the airspeed velocity of an unladen swallow?",
-                                              "I ask you, what do you really think of me?"]))
-
-    s5 = bot.get_reply(prompt)
-    while ((s3 == s5) or (s4 == s5)): # We got the same sentence twice, so get a new reply with different input
-        log("error","[_] Collision: %s" % s5)
-        r = random.choice([1,2])
-        if r == 1: # Say hello
-            s5 = bot.get_reply(random.choice(hellos))
-        if r == 2: # Use a random quote
-            s5 = bot.get_reply(random.choice(["Let any fish who meets my gaze learn the true meaning of fear; for I am the harbinger of death.",
-                                              "The other day I was talking with my neighbours and they mentioned hearing weird noises.",
-                                              "The legend tells that a long time ago all seawater was fresh.",
-                                              "I’ll have you know I graduated top of my class in the Navy Seals.",
-                                              "According to all known laws of aviation, there is no way that a bee should be able to fly.",
-                                              "The running speed starts slowly, but gets faster each minute after you hear this signal.",
-                                              "Did you ever hear the tragedy of Darth Plagueis The Wise?"]))
 
+    rs1 = smart_truncate(snip_hashtags(s1))
+    rs2 = smart_truncate(snip_hashtags(s2))
+    title = ''
 
+    r1 = rs1.split()
+    r2 = rs2.split()
+    if (frac < 0.3):
+        rl = r1[:math.ceil(len(r1)*(frac + random.choice([0,0.05,0.1,0.15,0.2])))]
+        rl.extend(r2[math.ceil(len(r2)*(frac + random.choice([0,0.05,0.1,0.15,0.2]))):math.ceil(len(r2)*(frac + random.choice([0.3,0.35,0.4])))])
+        rl.extend(r1[math.ceil(len(r1)*(frac + random.choice([0.05,0.1,0.15,0.2]))):])
+    else:
+        rl = r1[:math.ceil(len(r1)*(frac + random.choice([0,0.05,0.1,0.15,0.2])))]
+        rl.extend(r2[math.ceil(len(r2)*(frac + random.choice([0,0.05,0.1,0.15,0.2]))):])
+    title = smart_truncate(" ".join(rl),length=150)
+
+    return title
+
+def splice_body(s3, s4, s5):
+    "Splice three replies into body text."
+    # At which fraction should we splice the replies?
+    frac = random.choice([0.2,0.25,0.3,0.35,0.35,0.4,0.4,0.4])
 
     rs3 = smart_truncate(snip_hashtags(s3))
     rs4 = smart_truncate(snip_hashtags(s4))
@@ -420,6 +595,24 @@ def generate_body(bot, prompt):
 
     return body
 
+def log_training(progress):
+    "Report how far training has got."
+    log("info","[o] Trained %d lines (%d%%): %d lines/s, %d tokens/s." % (progress.lines, 100 * progress.offset / max(1, progress.size),
+                                                                       progress.lines_per_second, progress.tokens_per_second))
+
+def brain_files(brainfile: str) -> List[str]:
+    "The files a brain is kept in, some dbm modules add extensions (and dbm.dumb keeps a .bak too)."
+    return [name for name in [brainfile] + [brainfile + ext for ext in ('.db', '.dat', '.dir', '.bak')] if os.path.isfile(name)]
+
+def brain_modified(brainfile: str) -> Optional[float]:
+    "When the brain was last synced, going by its own files, or None if there is none."
+    times = [os.path.getmtime(name) for name in brain_files(brainfile)]
+    return max(times) if times else None
+
+def generate_body(bot, prompt, budget, learn=True):
+    "Generate body text for posts or comments."
+    return splice_body(*compose(bot, [(prompt, 3)], budget, learn)[0])
+
 def main():
     "Main program loop."
     global logged_in, debug
@@ -433,13 +626,15 @@ def main():
     brainnotfound = False
     learned = []
 
-    if not os.path.isfile(DEFAULT_BRAINFILE):
+    if KBOT_SNAPSHOT:
+        log("info",'[o] Starting from snapshot %s.' % KBOT_SNAPSHOT)
+    elif not brain_files(DEFAULT_BRAINFILE):
         brainnotfound = True
         brain = False
         train = True # If there's no brain, we gotta train
         log("info",'[o] No brain found, training mode on.')
     else:
-        log("info",'[o] Brain found: %s KB.' % int(os.stat(DEFAULT_BRAINFILE).st_size / 1024))
+        log("info",'[o] Brain found: %s KB.' % int(sum(os.path.getsize(name) for name in brain_files(DEFAULT_BRAINFILE)) / 1024))
 
     if len(sys.argv) > 1:
         # These are flags that can be invoked from the command line.
@@ -488,21 +683,71 @@ def main():
         if not (random.choice([0,1,2]) == 1):
             skipfirst = True
 
+    if KBOT_SNAPSHOT and (reset or train):
+        log("error",'[!] A snapshot cannot be reset or trained, do that to the brain file and export it again.')
+        reset = train = False
+
+    if not learn and (reset or train):
+        log("error",'[!] Not resetting or training: a bot that does not learn only reads the brain, do that with the learning bot.')
+        reset = train = False
+
     if reset:
-        os.remove(DEFAULT_BRAINFILE)
+        if os.path.isfile(DEFAULT_SNAPSHOT):
+            os.remove(DEFAULT_SNAPSHOT) # It was exported from the old brain
+        for name in brain_files(DEFAULT_BRAINFILE):
+            os.remove(name)
         log("info",'[x] Brain deleted, muahahaa!')
         train = True
         log("info",'[o] Training mode on.')
 
     # Initialize MegaHAL
-    hal = MegaHAL()
+    if not learn:
+        # Map a snapshot read-only instead, so any number of reply-only bots can share one copy of the brain
+        snapshot = KBOT_SNAPSHOT or DEFAULT_SNAPSHOT
+        brain_changed = brain_modified(DEFAULT_BRAINFILE)
+        # Our own snapshot is exported again whenever the learning bot's brain has been synced since
+        stale = snapshot == DEFAULT_SNAPSHOT and brain_changed is not None and os.path.isfile(snapshot) and brain_changed > os.path.getmtime(snapshot)
+        if not os.path.isfile(snapshot) or stale:
+            if brain_changed is None:
+                log("error",'[!] Snapshot %s not found, and there is no brain file to export it from.' % snapshot)
+                sys.exit(1)
+            try:
+                # Read-only, as last synced: the learning bot may have the brain open, and its journal is its own
+                reader = MegaHAL(store=KBOT_BRAIN_STORE, readonly=True)
+                if reader.training:
+                    log("info",'[o] The brain is partway through training from %s, exporting what it has learned so far.' % reader.training)
+                reader.export_snapshot(snapshot) # Written to a temp file and swapped in, bots mapping the old one keep it
+                reader.close()
+                log("info",'[o] Brain exported to %s.' % snapshot)
+            except Exception as e:
+                if not os.path.isfile(snapshot):
+                    log("error",f'[!] Could not export the brain to {snapshot}: {e}')
+                    sys.exit(1)
+                log("error",f'[!] Could not export the brain again, replying from the older {snapshot}: {e}')
+        hal = MegaHAL(brainfile=snapshot, workers=KBOT_WORKERS, readonly=True)
+    elif KBOT_SNAPSHOT:
+        hal = MegaHAL(brainfile=KBOT_SNAPSHOT, workers=KBOT_WORKERS)
+    else:
+        hal = MegaHAL(store=KBOT_BRAIN_STORE, workers=KBOT_WORKERS)
     log("info",'[*] MegaHAL loaded.')
 
-    if train or '--train' in sys.argv:
-        hal.train(DEFAULT_TRAINER)  # Learn from the training file
+    if hal.training: # We got interrupted last time, so pick up where we left off
+        log("info",'[o] Resuming training from %s.' % hal.training)
+        train = True
+
+    if train:
+        hal.train(hal.training or DEFAULT_TRAINER, checkpoint=KBOT_TRAIN_CHECKPOINT, progress=log_training)  # Learn from the training file
         train = False
         log("info","[o] Training complete.")
 
+    # Search for replies in the background while we sleep
+    bot = hal
+    if KBOT_REPLY_POOL:
+        bot = ReplyPool(hal, depth=KBOT_REPLY_POOL)
+        log("info",'[*] Reply pool started.')
+
+    last_compacted = time()
+
     while True:
         try:
             try:
@@ -523,49 +768,15 @@ def main():
             if not skipfirst:
 
                 log("debug","[!] This should not appear if the following word is 'True': %s" % skipfirst)
-                # 2a: Title
-
-                # At which fraction should we splice the replies?
-                frac = random.choice([0.2,0.25,0.3,0.35,0.35,0.4,0.4,0.4])
-                # Get two replies and splice them together, for extra variety
-                s1 = hal.get_reply('')
-                s2 = hal.get_reply('')
-                while (s1 == s2): # We got the same sentence twice, so get a new reply with different input
-                    log("error","[_] Collision: %s" % s2)
-                    r = random.choice([1,2])
-                    if r == 1: # Say hello
-                        s2 = hal.get_reply(random.choice(hellos))
-                    if r == 2: # Use a random quote
-                        s2 = hal.get_reply(random.choice(["The sun is a mass of incandescent gas, a gigantic nuclear furnace where hydrogen is built into helium at a temperature of millions of degrees.",
-                                                          "You only live once, but if you do it right, once is enough.",
-                                                          "If you tell the truth, you don't have to remember anything.",
-                                                          "I am so clever that sometimes I don't understand a single word of what I am saying.",
-                                                          "Pardon me, but do you have any Grey Poupon?",
-                                                          "What is the airspeed velocity of an unladen swallow?",
-                                                          "I ask you, what do you really think of me?"]))
-
-                rs1 = smart_truncate(snip_hashtags(s1))
-                rs2 = smart_truncate(snip_hashtags(s2))
-                title = ''
-
-                r1 = rs1.split()
-                r2 = rs2.split()
-                if (frac < 0.3):
-                    rl = r1[:math.ceil(len(r1)*(frac + random.choice([0,0.05,0.1,0.15,0.2])))]
-                    rl.extend(r2[math.ceil(len(r2)*(frac + random.choice([0,0.05,0.1,0.15,0.2]))):math.ceil(len(r2)*(frac + random.choice([0.3,0.35,0.4])))])
-                    rl.extend(r1[math.ceil(len(r1)*(frac + random.choice([0.05,0.1,0.15,0.2]))):])
-                else:
-                    rl = r1[:math.ceil(len(r1)*(frac + random.choice([0,0.05,0.1,0.15,0.2])))]
-                    rl.extend(r2[math.ceil(len(r2)*(frac + random.choice([0,0.05,0.1,0.15,0.2]))):])
-                title = smart_truncate(" ".join(rl),length=150)
+                # 2a: Title and 2b: Body, searched for under one budget
+                title_replies, body_replies = compose(bot, [('', 2), ('', 3)], KBOT_POST_BUDGET, learn)
+                title = splice_title(*title_replies)
 
                 log("debug","Generated text (title): %s" % title) # Print the final reply
 
                 #if(last_updated < pub_date):
 
-                # 2b: Body
-
-                body = generate_body(hal, '')
+                body = splice_body(*body_replies)
 
                 log("debug","Generated text (body): %s" % body) # Print the final reply
 
@@ -588,11 +799,16 @@ def main():
         
             #new_threads = list_threads(KBOT_MAGAZINE, True)
 
-            if toot and threads:
+            if toot and threads and KBOT_REPLIES > 1 and aiohttp is not None:
+                thread_ids = random.sample(list(threads.keys()), min(KBOT_REPLIES, len(threads)))
+                replies = asyncio.run(post_replies(bot, KBOT_MAGAZINE, thread_ids, learn))
+                result = any(replies.values())
+                log("info",f"Replied to {sum(replies.values())} of {len(replies)} threads.")
+            elif toot and threads:
                 thread_id = random.choice(list(threads.keys()))
                 #log("debug",thread_id)
                 #log("debug",list(threads.keys()))
-                result = post_reply(hal, KBOT_MAGAZINE, thread_id)
+                result = post_reply(bot, KBOT_MAGAZINE, thread_id, learn)
                 if not result:
                     log("error","Reply Failed! Attempting to login and post again...")
                     result = login() and post(title, body)
@@ -622,6 +838,17 @@ def main():
                     if os.path.exists(f"{cache_name}.bak"):
                         os.remove(f"{cache_name}.bak")
 
+            if bot is not hal:
+                log("debug","[o] Reply pool: %s" % bot.stats())
+            log("debug","[o] Rate limiter: %s" % kbin_session.limiter.stats())
+
+            if KBOT_COMPACT_HOURS and hal.store != "snapshot" and time() - last_compacted >= KBOT_COMPACT_HOURS * 3600:
+                # Keep the brain from growing forever (instead of --reset)
+                compaction = bot.compact(KBOT_COMPACT_MIN_COUNT)
+                last_compacted = time()
+                log("info","[o] Brain compacted: %d -> %d nodes, %d -> %d words." % compaction)
+            elif hal.store == "sqlite":
+                bot.sync() # Only writes what changed this cycle
             sleep(KBOT_FREQUENCY)
         except KeyboardInterrupt:
             logging.info("Shutting down...")
@@ -630,6 +857,8 @@ def main():
             logging.error("Unhandled Error:", e)
             sleep(KBOT_FREQUENCY)
 
+    if bot is not hal:
+        bot.close()
     hal.close()
 
 if __name__ == "__main__":
@@ -29,21 +29,58 @@
 """Python implementation of megahal markov bot"""
 
 from time import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque, namedtuple
+from itertools import accumulate
 import shelve
+import dbm
+import importlib
+import sqlite3
+import pickle
+import mmap
+import struct
+import json
 import random
 import math
+import multiprocessing
 import os
 import io
+import pathlib
+import sys
+import weakref
 import regex as re
 
+try:
+    import numpy  # Optional, scores reply candidates in batches
+except ImportError:
+    numpy = None
+
 __version__ = '0.2'
 __author__ = 'Chris Jones <cjones@gruntle.org>'
 __license__ = 'BSD'
-__all__ = ['MegaHAL', 'Dictionary', 'Tree', '__version__', 'DEFAULT_ORDER', 'DEFAULT_BRAINFILE', 'DEFAULT_TIMEOUT']
+__all__ = ['MegaHAL', 'Dictionary', 'Tree', 'ArrayTree', '__version__', 'DEFAULT_ORDER', 'DEFAULT_BRAINFILE', 'DEFAULT_TIMEOUT',
+           'DEFAULT_ENGINE', 'DEFAULT_STORE', 'DEFAULT_WORKERS', 'TRAIN_CHECKPOINT_LINES',
+           'COMPACT_MIN_COUNT', 'SNAPSHOT_VERSION']
 
 DEFAULT_ORDER = 5
 DEFAULT_BRAINFILE = '.hal-kbot-brain' #os.path.join(os.environ.get('HOME', ''), '.pymegahal-brain')
 DEFAULT_TIMEOUT = 1.0
+DEFAULT_ENGINE = 'tree'
+DEFAULT_STORE = 'shelve'
+DEFAULT_WORKERS = 1
+POOL_REFRESH_PHRASES = 256
+JOURNAL_SYNC_PHRASES = 16
+JOURNAL_SYNC_SECONDS = 5.0
+TRAIN_CHECKPOINT_LINES = 10000
+TRAIN_CHUNK_BYTES = 1 << 20
+COMPACT_MIN_COUNT = 2
+FLAG_BANNED = 1  # Symbol flags, see Brain.get_flags
+FLAG_AUX = 2
+TRANSITION_CACHE_SIZE = 65536
+SCORE_BATCH = 32  # Candidates generated before scoring them together, see Brain.evaluate_replies
+SNAPSHOT_MAGIC = b'MHALSNAP'
+SNAPSHOT_VERSION = 1
 
 API_VERSION = '1.0'
 END_WORD = '<FIN>'
@@ -93,8 +130,19 @@ DEFAULT_SWAPWORDS = {"YOU'RE": "I'M", "YOU'D": "I'D", 'HATE': 'LOVE', 'YOUR': 'M
                      'DISLIKE': 'LIKE', "I'M": "YOU'RE", 'ME': 'YOU', 'MYSELF': 'YOURSELF', 'LIKE': 'DISLIKE',
                      "I'D": "YOU'D", "YOU'VE": "I'VE", 'YES': 'NO', 'MY': 'YOUR'}
 
+# Words are runs of letters (joined across single apostrophes, as in DON'T), runs of digits, or runs of anything else
+LETTER_REGEX = re.compile(r"\p{L}")
+WORD_REGEX = re.compile(r"\p{L}+(?:'\p{L}+)*|[\p{Nt=De}\p{Nt=Di}]+|[^\p{L}\p{Nt=De}\p{Nt=Di}]+")
+
+# Tree node -> its Sampler, see Tree.get_sampler
+tree_samplers = weakref.WeakKeyDictionary()
+
+
 class Tree(object):
 
+    WIDE_FANOUT = 8  # Nodes with more children than this get a symbol index, narrower ones are scanned
+    index = None  # ChildIndex, on wide nodes only
+
     def __init__(self, symbol=0):
         self.symbol = symbol
         self.usage = 0
@@ -107,20 +155,688 @@ class Tree(object):
         self.usage += 1
         return node
 
+    def add_counts(self, count, usage):
+        self.count += count
+        self.usage += usage
+
+    def get_sampler(self):
+        # Kept beside the node rather than on it, so pickling a tree needn't leave anything out.  Any change to
+        # the children's counts changes the usage too, and a new child changes their number
+        sampler = tree_samplers.get(self)
+        if sampler is None or sampler.usage != self.usage or len(sampler.symbols) != len(self.children):
+            sampler = tree_samplers[self] = Sampler([child.symbol for child in self.children],
+                                                    [child.count for child in self.children], self.usage)
+        return sampler
+
     def get_child(self, symbol, add=True):
-        for child in self.children:
-            if child.symbol == symbol:
-                break
+        index = self.index
+        if not index and len(self.children) > self.WIDE_FANOUT:
+            # Grown wide, or loaded from a brain file, build the index on first use
+            index = self.index = ChildIndex((child.symbol, child) for child in reversed(self.children))
+        if index:
+            child = index.get(symbol)
         else:
-            if add:
-                child = Tree(symbol)
-                self.children.append(child)
+            for child in self.children:
+                if child.symbol == symbol:
+                    break
             else:
                 child = None
+        if child is None and add:
+            child = Tree(symbol)
+            self.children.append(child)
+            if index:
+                index[symbol] = child
+        return child
+
+
+class ChildIndex(dict):
+    """A wide Tree node's children by symbol.  It's saved empty rather than repeating the children, and
+    rebuilt from them the first time it's needed after loading."""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        return ChildIndex, ()
+
+
+class Sampler(object):
+    """Running totals of a node's child counts, so babble can find a child by bisection"""
+
+    __slots__ = ('symbols', 'cumulative', 'positions', 'usage')
+
+    def __init__(self, symbols, counts, usage=None):
+        self.symbols = symbols
+        self.cumulative = [0]
+        self.cumulative.extend(accumulate(counts))
+        self.positions = None
+        self.usage = usage
+
+    def position(self, symbol):
+        if self.positions is None:
+            self.positions = {}
+            for i, child in enumerate(self.symbols):
+                self.positions.setdefault(child, i)
+        return self.positions.get(symbol)
+
+
+class ArrayNode(object):
+    """Lightweight handle on one node of an ArrayTree, quacking like a Tree"""
+
+    __slots__ = ('tree', 'id')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.id = id
+
+    @property
+    def symbol(self):
+        return self.tree.symbols[self.id]
+
+    @property
+    def count(self):
+        return self.tree.counts[self.id]
+
+    @property
+    def usage(self):
+        return self.tree.usages[self.id]
+
+    @property
+    def children(self):
+        return ArrayChildren(self.tree, self.id)
+
+    def get_sampler(self):
+        return self.tree.node_sampler(self.id)
+
+    def add_counts(self, count, usage):
+        self.tree.count_node(self.id, count, usage)
+
+    def add_symbol(self, symbol):
+        return ArrayNode(self.tree, self.tree.add_child(self.id, symbol))
+
+    def get_child(self, symbol, add=True):
+        if add:
+            child = self.tree.add_child(self.id, symbol, count=False)
+        else:
+            child = self.tree.find_child(self.id, symbol)
+            if child is None:
+                return None
+        return ArrayNode(self.tree, child)
+
+
+class ArrayChildren(object):
+    """Read-only sequence view of an ArrayTree node's children, in insertion order"""
+
+    __slots__ = ('tree', 'first', 'size')
+
+    def __init__(self, tree, id):
+        self.tree = tree
+        self.first = tree.firsts[id]
+        self.size = tree.sizes[id]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('child index out of range')
+        return ArrayNode(self.tree, self.tree.edges[self.first + i])
+
+    def __iter__(self):
+        tree = self.tree
+        for child in tree.edges[self.first:self.first + self.size]:
+            yield ArrayNode(tree, child)
+
+
+class ArrayTree(object):
+    """Trie kept as flat typed arrays, one slot per node, instead of Tree objects.
+
+    Node 0 is the root.  Each node's children are stored contiguously in edges
+    (child ids) and edge_symbols (their symbols), starting at firsts[node]; when
+    a node outgrows its block the block is moved to the end of the arrays with
+    double the capacity.  Children keep their insertion order, so sampling
+    behaves exactly like the Tree engine.  Nodes with many children also get a
+    symbol->child dict, built on demand and never pickled.
+
+    When dirty is a set, every node whose count or usage changes is added to it
+    so a store can write back only those nodes.
+
+    The tree itself acts as its root node, so it can be handed to a Context
+    wherever a Tree is expected.
+    """
+
+    WIDE_FANOUT = 64
+
+    def __init__(self):
+        self.symbols = array('I', [0])
+        self.counts = array('I', [0])
+        self.usages = array('I', [0])
+        self.parents = array('I', [0])
+        self.firsts = array('I', [0])
+        self.sizes = array('I', [0])
+        self.capacities = array('I', [0])
+        self.edges = array('I')
+        self.edge_symbols = array('I')
+        self.wide = {}
+        self.samplers = {}
+        self.dirty = None
+        self.sorted_edges = None
+        self.new_edges = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('wide', None)
+        state.pop('samplers', None)
+        state.pop('dirty', None)
+        state.pop('sorted_edges', None)
+        state.pop('new_edges', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.wide = {}
+        self.samplers = {}
+        self.dirty = None
+        self.sorted_edges = None
+        self.new_edges = None
+
+    def __len__(self):
+        return len(self.symbols)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Convert a Tree (as stored in older brains) into an ArrayTree"""
+        self = cls()
+        # Number the nodes breadth first, so each node's children are the next run of ids and edges
+        nodes = [tree]
+        parents = [0]
+        for id, node in enumerate(nodes):
+            nodes.extend(node.children)
+            parents.extend([id] * len(node.children))
+        sizes = [len(node.children) for node in nodes]
+        self.symbols = array('I', [node.symbol for node in nodes])
+        self.counts = array('I', [node.count for node in nodes])
+        self.usages = array('I', [node.usage for node in nodes])
+        self.parents = array('I', parents)
+        self.firsts = array('I', [0])
+        self.firsts.extend(accumulate(sizes[:-1]))
+        self.sizes = array('I', sizes)
+        self.capacities = array('I', sizes)
+        self.edges = array('I', range(1, len(nodes)))
+        self.edge_symbols = self.symbols[1:]
+        return self
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Rebuild an ArrayTree from (id, parent, symbol, count, usage) rows sorted by id"""
+        self = cls()
+        for id, parent, symbol, count, usage in rows:
+            if id == 0:
+                self.symbols[0], self.counts[0], self.usages[0] = symbol, count, usage
+            else:
+                self.new_node(parent, symbol, count, usage)
+                self.sizes[parent] += 1
+        # Children were created in id order, so grouping by parent keeps their original order
+        first = 0
+        for id, size in enumerate(self.sizes):
+            self.firsts[id] = first
+            self.capacities[id] = size
+            first += size
+        self.edges = array('I', [0]) * first
+        self.edge_symbols = array('I', [0]) * first
+        filled = array('I', [0]) * len(self.symbols)
+        for id in range(1, len(self.symbols)):
+            parent = self.parents[id]
+            slot = self.firsts[parent] + filled[parent]
+            self.edges[slot] = id
+            self.edge_symbols[slot] = self.symbols[id]
+            filled[parent] += 1
+        return self
+
+    def new_node(self, parent, symbol, count=0, usage=0):
+        id = len(self.symbols)
+        self.symbols.append(symbol)
+        self.counts.append(count)
+        self.usages.append(usage)
+        self.parents.append(parent)
+        self.firsts.append(0)
+        self.sizes.append(0)
+        self.capacities.append(0)
+        return id
+
+    def find_child(self, node, symbol):
+        size = self.sizes[node]
+        if size >= self.WIDE_FANOUT:
+            index = self.wide.get(node)
+            if index is None:
+                first = self.firsts[node]
+                index = self.wide[node] = dict(zip(reversed(self.edge_symbols[first:first + size]),
+                                                   reversed(self.edges[first:first + size])))
+            return index.get(symbol)
+        first = self.firsts[node]
+        try:
+            return self.edges[self.edge_symbols.index(symbol, first, first + size)]
+        except ValueError:
+            return None
+
+    def add_child(self, node, symbol, count=True):
+        child = self.find_child(node, symbol)
+        if child is None:
+            child = self.new_node(node, symbol)
+            first, size, capacity = self.firsts[node], self.sizes[node], self.capacities[node]
+            if size == capacity:
+                capacity = max(2, capacity * 2)
+                start = len(self.edges)
+                self.edges.extend(self.edges[first:first + size])
+                self.edges.extend(array('I', [0]) * (capacity - size))
+                self.edge_symbols.extend(self.edge_symbols[first:first + size])
+                self.edge_symbols.extend(array('I', [0]) * (capacity - size))
+                self.firsts[node], self.capacities[node] = start, capacity
+                first = start
+            self.edges[first + size] = child
+            self.edge_symbols[first + size] = symbol
+            self.sizes[node] = size + 1
+            index = self.wide.get(node)
+            if index is not None:
+                index.setdefault(symbol, child)
+            self.samplers.pop(node, None)
+        if count:
+            self.counts[child] += 1
+            self.usages[node] += 1
+            self.samplers.pop(node, None)
+            if self.dirty is not None:
+                self.dirty.add(node)
+                self.dirty.add(child)
+        return child
+
+    def edge_index(self):
+        """Every edge as sorted (parent << 32 | symbol) keys and the child ids they lead to, for find_children.
+
+        Nodes never move, so the index is only sorted again once the nodes added since make up an eighth of it;
+        until then those are kept in a second, small index.
+        """
+        size = len(self.symbols)
+        if self.sorted_edges is None or (size - self.sorted_edges[0]) * 8 > self.sorted_edges[0]:
+            self.sorted_edges = (size,) + sort_edges(self.parents, self.symbols, 1, size)
+            self.new_edges = None
+        if self.new_edges is None or self.new_edges[0] != size:
+            self.new_edges = (size,) + sort_edges(self.parents, self.symbols, self.sorted_edges[0], size)
+        return self.sorted_edges[1:], self.new_edges[1:]
+
+    def find_children(self, nodes, symbols, index=None):
+        """find_child for numpy arrays of nodes and symbols at once, with -1 for no node in and no child out.
+
+        index, if given, is an edge_index() taken earlier, which only finds the nodes there were then.
+        """
+        keys = nodes.astype(numpy.int64) << 32 | symbols
+        children = numpy.full(len(keys), -1, numpy.int64)
+        for edges, ids in index or self.edge_index():
+            if len(edges):
+                found = numpy.minimum(numpy.searchsorted(edges, keys), len(edges) - 1)
+                hit = (nodes >= 0) & (edges[found] == keys)
+                children[hit] = ids[found[hit]]
+        return children
+
+    def node_sampler(self, node):
+        sampler = self.samplers.get(node)
+        if sampler is None:
+            first = self.firsts[node]
+            children = self.edges[first:first + self.sizes[node]]
+            counts = self.counts
+            sampler = self.samplers[node] = Sampler(self.edge_symbols[first:first + len(children)].tolist(),
+                                                    [counts[child] for child in children])
+        return sampler
+
+    def count_node(self, node, count, usage):
+        self.counts[node] += count
+        self.usages[node] += usage
+        if usage:
+            self.samplers.pop(node, None)
+        if self.dirty is not None:
+            self.dirty.add(node)
+
+    def merge_into(self, target, symbols):
+        """Add this tree's nodes and counts to target, a Tree or ArrayTree root, mapping each symbol s to symbols[s].
+
+        Children new to target are appended in this tree's order, so merging the trees learned from consecutive
+        parts of a text, in order, gives the same tree as learning the whole text.
+        """
+        if numpy is not None and type(target) is ArrayTree:
+            return target.merge_arrays(self, symbols)
+        counts, usages, sizes, firsts, edges = self.counts, self.usages, self.sizes, self.firsts, self.edges
+        mapped = [symbols[symbol] for symbol in self.symbols]
+        target.add_counts(counts[0], usages[0])
+        queue = deque([(0, target)])
+        copies = []
+        while queue:
+            id, node = queue.popleft()
+            first = firsts[id]
+            for child in edges[first:first + sizes[id]]:
+                handle = node.get_child(mapped[child])
+                handle.add_counts(counts[child], usages[child])
+                if sizes[child]:
+                    if type(handle) is Tree and not handle.children:
+                        copies.append((child, handle))
+                    else:
+                        queue.append((child, handle))
+        # Most of a merged tree is new to target, and children there's nothing to match against can be copied
+        # without looking each one up
+        while copies:
+            id, node = copies.pop()
+            first = firsts[id]
+            children = node.children
+            for child in edges[first:first + sizes[id]]:
+                copy = Tree(mapped[child])
+                copy.count = counts[child]
+                copy.usage = usages[child]
+                children.append(copy)
+                if sizes[child]:
+                    copies.append((child, copy))
+
+    def merge_arrays(self, source, symbols):
+        """source.merge_into(self, symbols), a level of source at a time with numpy.
+
+        Every node of a level is matched to its node here at once, the missing ones are added together, and the
+        nodes that gained children have their edges moved to the end, the old ones first.
+        """
+        size = len(self.symbols)
+        index = self.edge_index()
+        mapped = numpy.asarray(symbols, numpy.int64)[numpy.frombuffer(source.symbols, numpy.uintc)]
+        source_firsts = numpy.frombuffer(source.firsts, numpy.uintc)
+        source_sizes = numpy.frombuffer(source.sizes, numpy.uintc)
+        source_edges = numpy.frombuffer(source.edges, numpy.uintc)
+        level = numpy.zeros(1, numpy.int64)
+        nodes = numpy.zeros(1, numpy.int64)
+        merged, into, added, grown = [level], [nodes], [], []
+        while True:
+            slots, owners = child_slots(source_firsts, source_sizes, level)
+            if not len(slots):
+                break
+            level = source_edges[slots].astype(numpy.int64)
+            parents = nodes[owners]
+            nodes = self.find_children(parents, mapped[level], index)
+            new = numpy.flatnonzero(nodes < 0)
+            if len(new):
+                nodes[new] = numpy.arange(size, size + len(new))
+                size += len(new)
+                added.append((parents[new], mapped[level[new]]))
+                grown.append(parents[new])
+            merged.append(level)
+            into.append(nodes)
+        merged, into = numpy.concatenate(merged), numpy.concatenate(into)
+
+        old = len(self.symbols)
+        if added:
+            parents = numpy.concatenate([parents for parents, symbols in added]).astype(numpy.uintc)
+            zeros = numpy.zeros(len(parents), numpy.uintc).tobytes()
+            self.symbols.frombytes(numpy.concatenate([symbols for parents, symbols in added]).astype(numpy.uintc).tobytes())
+            self.parents.frombytes(parents.tobytes())
+            for column in (self.counts, self.usages, self.firsts, self.sizes, self.capacities):
+                column.frombytes(zeros)
+        for column, values in ((self.counts, source.counts), (self.usages, source.usages)):
+            column = numpy.frombuffer(column, numpy.uintc)
+            column[into] += numpy.frombuffer(values, numpy.uintc)[merged]
+            del column  # A numpy view keeps the array from growing
+        if added:
+            # New children of a node were found together, so they're a run of the new ids, in source order
+            grown = numpy.concatenate(grown)
+            nodes, counts = numpy.unique(grown, return_counts=True)
+            firsts = numpy.frombuffer(self.firsts, numpy.uintc)
+            sizes = numpy.frombuffer(self.sizes, numpy.uintc)
+            slots, owners = child_slots(firsts, sizes, nodes)
+            children = numpy.concatenate([numpy.frombuffer(self.edges, numpy.uintc)[slots],
+                                          (old + numpy.argsort(grown, kind='stable')).astype(numpy.uintc)])
+            order = numpy.argsort(numpy.concatenate([owners, numpy.repeat(numpy.arange(len(nodes)), counts)]),
+                                  kind='stable')
+            children = children[order]
+            lengths = sizes[nodes] + counts
+            firsts[nodes] = len(self.edges) + numpy.cumsum(lengths) - lengths
+            sizes[nodes] = lengths
+            numpy.frombuffer(self.capacities, numpy.uintc)[nodes] = lengths
+            del firsts, sizes
+            self.edges.frombytes(children.tobytes())
+            self.edge_symbols.frombytes(numpy.frombuffer(self.symbols, numpy.uintc)[children].tobytes())
+            if len(self.edges) > 2 * len(self.symbols):
+                self.pack_edges()
+        self.wide = {}
+        self.samplers = {}
+        if self.dirty is not None:
+            self.dirty.update(into[into < old].tolist())
+
+    def pack_edges(self):
+        """Lay every node's edges out again in id order, dropping the space runs that moved away left behind"""
+        firsts = numpy.frombuffer(self.firsts, numpy.uintc)
+        sizes = numpy.frombuffer(self.sizes, numpy.uintc)
+        slots, owners = child_slots(firsts, sizes, numpy.arange(len(sizes)))
+        edges = numpy.frombuffer(self.edges, numpy.uintc)[slots]
+        firsts[:] = numpy.cumsum(sizes) - sizes
+        numpy.frombuffer(self.capacities, numpy.uintc)[:] = sizes
+        del firsts, sizes
+        self.edges = array('I', edges.tobytes())
+        self.edge_symbols = array('I', numpy.frombuffer(self.symbols, numpy.uintc)[edges].tobytes())
+
+    # The tree doubles as a handle on its own root node
+
+    @property
+    def symbol(self):
+        return self.symbols[0]
+
+    @property
+    def count(self):
+        return self.counts[0]
+
+    @property
+    def usage(self):
+        return self.usages[0]
+
+    @property
+    def children(self):
+        return ArrayChildren(self, 0)
+
+    def get_sampler(self):
+        return self.node_sampler(0)
+
+    def add_counts(self, count, usage):
+        self.count_node(0, count, usage)
+
+    def add_symbol(self, symbol):
+        return ArrayNode(self, self.add_child(0, symbol))
+
+    def get_child(self, symbol, add=True):
+        return ArrayNode(self, 0).get_child(symbol, add)
+
+
+class MappedTree(ArrayTree):
+    """Read-only ArrayTree over arrays mapped from a snapshot file.
+
+    Snapshots number the nodes breadth first, so a node's children are the
+    consecutive ids from firsts[node] and need no edges array.  Each node's
+    children are also listed sorted by symbol, for finding one by bisection.
+    """
+
+    def __init__(self, symbols, counts, usages, firsts, sizes, sorted_symbols, sorted_children):
+        self.symbols = symbols
+        self.counts = counts
+        self.usages = usages
+        self.firsts = firsts
+        self.sizes = sizes
+        self.edges = range(len(symbols))
+        self.edge_symbols = symbols
+        self.sorted_symbols = sorted_symbols
+        self.sorted_children = sorted_children
+        self.wide = {}
+        self.samplers = {}
+        self.dirty = None
+        self.edge_keys = None
+
+    def __getstate__(self):
+        raise TypeError('A mapped tree lives in its snapshot file and cannot be pickled')
+
+    def find_child(self, node, symbol):
+        # Children ids start at 1, so the sorted lists are indexed by child id - 1
+        start = self.firsts[node] - 1
+        end = start + self.sizes[node]
+        i = bisect_left(self.sorted_symbols, symbol, start, end)
+        if i < end and self.sorted_symbols[i] == symbol:
+            return self.sorted_children[i]
+        return None
+
+    def edge_index(self):
+        # Children are listed parent by parent and sorted within each parent, so the keys come out sorted already
+        if self.edge_keys is None:
+            parents = numpy.repeat(numpy.arange(len(self.sizes), dtype=numpy.int64),
+                                   numpy.frombuffer(self.sizes, numpy.uintc))
+            self.edge_keys = ((parents << 32 | numpy.frombuffer(self.sorted_symbols, numpy.uintc),
+                               numpy.frombuffer(self.sorted_children, numpy.uintc).astype(numpy.int64)),)
+        return self.edge_keys
+
+    def add_child(self, node, symbol, count=True):
+        raise TypeError('A snapshot is read-only')
+
+    def count_node(self, node, count, usage):
+        raise TypeError('A snapshot is read-only')
+
+
+class OverlayTree(Tree):
+    """Tree node copied from a snapshot node once something is learned under it.
+
+    Until then it reads straight through to the snapshot.  Its children stay
+    snapshot nodes too, each one copied in turn when learning first changes it.
+    """
+
+    def __init__(self, node):
+        self.symbol = node.symbol
+        self.usage = node.usage
+        self.count = node.count
+        self.base = node
+        self.index = None
+
+    def __getattr__(self, name):
+        if name == 'children':
+            return self.base.children
+        raise AttributeError(name)
+
+    def get_sampler(self):
+        if 'children' not in self.__dict__:
+            return self.base.get_sampler()
+        return Tree.get_sampler(self)
+
+    def get_child(self, symbol, add=True):
+        if not add:
+            if 'children' not in self.__dict__:
+                return self.base.get_child(symbol, add=False)
+            return Tree.get_child(self, symbol, add=False)
+        if 'children' not in self.__dict__:
+            self.children = list(self.base.children)
+        child = Tree.get_child(self, symbol)
+        if isinstance(child, ArrayNode):
+            copy = OverlayTree(child)
+            self.children[self.children.index(child)] = copy
+            if self.index:
+                self.index[symbol] = copy
+            child = copy
         return child
 
 
+ENGINES = {'tree': Tree, 'array': ArrayTree}
+
+
 class Dictionary(list):
+    """List of words indexed by symbol, with a word->symbol map for lookups.
+
+    The map is never pickled; it is rebuilt on first use after loading a brain
+    and thrown away whenever the list is changed by anything but append().
+    Those changes also bump version, so tables built from the words can tell
+    when they are out of date.
+    """
+
+    lookup = None
+    version = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('lookup', None)
+        state.pop('version', None)
+        return state or None
+
+    def get_lookup(self):
+        lookup = self.lookup
+        if lookup is None:
+            lookup = self.lookup = {}
+            for symbol, word in enumerate(self):
+                lookup.setdefault(word, symbol)
+        return lookup
+
+    def invalidate(self):
+        self.lookup = None
+        self.version += 1
+
+    def index(self, word, *args):
+        if args:
+            return list.index(self, word, *args)
+        try:
+            return self.get_lookup()[word]
+        except (KeyError, TypeError):
+            raise ValueError('%r is not in dictionary' % (word,))
+
+    def __contains__(self, word):
+        try:
+            return word in self.get_lookup()
+        except TypeError:
+            return False
+
+    def append(self, word):
+        list.append(self, word)
+        if self.lookup is not None:
+            self.lookup.setdefault(word, len(self) - 1)
+
+    def extend(self, words):
+        list.extend(self, words)
+        self.invalidate()
+
+    def insert(self, i, word):
+        list.insert(self, i, word)
+        self.invalidate()
+
+    def remove(self, word):
+        list.remove(self, word)
+        self.invalidate()
+
+    def pop(self, *args):
+        word = list.pop(self, *args)
+        self.invalidate()
+        return word
+
+    def clear(self):
+        list.clear(self)
+        self.invalidate()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.invalidate()
+
+    def reverse(self):
+        list.reverse(self)
+        self.invalidate()
+
+    def __setitem__(self, i, word):
+        list.__setitem__(self, i, word)
+        self.invalidate()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self.invalidate()
+
+    def __iadd__(self, words):
+        list.__iadd__(self, words)
+        self.invalidate()
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.invalidate()
+        return self
 
     def add_word(self, word):
         try:
@@ -136,19 +852,645 @@ class Dictionary(list):
             return 0
 
 
+class TransitionCache(OrderedDict):
+    """Least recently used contexts a reply search walked into, see Brain.get_context.
+
+    Maps (tree, path), path being the last order + 1 symbols, to [nodes, probability]: the context nodes that
+    path leads to and, once evaluate_reply has needed it, the probability of its last symbol.
+    """
+
+    def __init__(self, size=TRANSITION_CACHE_SIZE):
+        OrderedDict.__init__(self)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        entry = self.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.move_to_end(key)
+        return entry
+
+    def store(self, key, entry):
+        self[key] = entry
+        if len(self) > self.size:
+            self.popitem(last=False)
+
+    def reset(self):
+        self.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class Context(object):
+    """Where a walk through one of a brain's trees has got to, as the nodes for the last 0 to order + 1 symbols.
+
+    Use it as a context manager from Brain.get_context; leaving it adds the end symbol and hands it back to
+    the brain for the next walk.
+    """
+
+    __slots__ = ('brain', 'tree', 'learn', 'nodes', 'used_key', 'path', 'entry')
+
+    def __init__(self, brain):
+        self.brain = brain
+        self.nodes = [None] * (brain.order + 2)
+
+    def __enter__(self):
+        self.nodes[0] = self.tree
+        for i in range(1, len(self.nodes)):
+            self.nodes[i] = None
+        self.used_key = False
+        self.path = ()
+        self.entry = None
+        return self
+
+    def __exit__(self, *exc_info):
+        self.update(self.brain.end_symbol)
+        self.tree = None
+        self.brain.contexts.append(self)
+
+    @property
+    def root(self):
+        return self.nodes[0]
+
+    def update(self, symbol):
+        # Learning changes the trees, so only contexts that just follow them go through the cache
+        if self.learn:
+            self.walk(symbol)
+            return
+        transitions = self.brain.transitions
+        # The nodes only depend on the last order + 1 symbols
+        path = self.path = (self.path + (symbol,))[1 - len(self.nodes):]
+        entry = self.entry = transitions.lookup((self.tree, path))
+        if entry is not None:
+            self.nodes[1:] = entry[0]
+            return
+        self.walk(symbol)
+        self.entry = [tuple(self.nodes[1:]), None]
+        transitions.store((self.tree, path), self.entry)
+
+    def walk(self, symbol):
+        nodes = self.nodes
+        for i in range(len(nodes) - 1, 0, -1):
+            node = nodes[i - 1]
+            if self.learn:
+                if node is not None:
+                    nodes[i] = node.add_symbol(symbol)
+            elif node is not None:
+                # Only follow what was learned, replies must not add to the trees
+                nodes[i] = node.get_child(symbol, add=False)
+            else:
+                nodes[i] = None
+
+    def probability(self, symbol):
+        """How likely symbol, just added, was after each context that holds it, or None without any"""
+        if self.entry is not None and self.entry[1] is not None:
+            return self.entry[1]
+        prob = 0.0
+        count = 0
+        for node in self.nodes[:-2]:
+            if node is not None:
+                child = node.get_child(symbol, add=False)
+                if child:
+                    prob += float(child.count) / node.usage
+                count += 1
+        if not count:
+            return None
+        if self.entry is not None:
+            self.entry[1] = prob / count
+        return prob / count
+
+    def seed(self, seeds):
+        if seeds:
+            i = random.randrange(len(seeds))
+            for symbol in seeds[i:] + seeds[:i]:
+                if symbol is not None:
+                    return symbol
+        if self.root.children:
+            return random.choice(self.root.children).symbol
+        return 0
+
+    def babble(self, keysymbols, symbols):
+        for deeper in self.nodes[:-1]:
+            if deeper is not None:
+                node = deeper
+        sampler = node.get_sampler()
+        size = len(sampler.symbols)
+        if not size:
+            return 0
+        i = random.randrange(size)
+        count = random.randrange(node.usage)
+        # Walking the children round from i, taking away their counts, find the one where count runs out
+        cumulative = sampler.cumulative
+        laps, count = divmod(count, cumulative[-1])
+        target = cumulative[i] + count
+        if target >= cumulative[-1]:
+            target -= cumulative[-1]
+        j = bisect_right(cumulative, target) - 1
+        # A keyword met on the way there is taken instead
+        eligible = keysymbols.every if self.used_key else keysymbols.plain
+        if eligible:
+            steps = size if laps else (j - i) % size
+            first = None
+            for symbol in eligible:
+                position = sampler.position(symbol)
+                if position is not None and (position - i) % size <= steps:
+                    if first is None or (position - i) % size < (first - i) % size:
+                        first = position
+            if first is not None:
+                self.used_key = True
+                return sampler.symbols[first]
+        return sampler.symbols[j]
+
+
+class SQLiteStore(object):
+    """Brain storage in an sqlite database, a drop-in for the shelve Brain uses.
+
+    The forward and backward trees live in the nodes table and the dictionary in
+    the words table; every other key is pickled into the meta table.  Trees are
+    loaded into ArrayTrees that track which nodes changed, so sync() only writes
+    the nodes and words added or updated since the previous sync.  Read-only,
+    the database is opened in sqlite's read-only mode and sync writes nothing.
+    """
+
+    TREES = ('forward', 'backward')
+
+    def __init__(self, file, readonly=False):
+        self.readonly = readonly
+        if readonly:
+            self.conn = sqlite3.connect(pathlib.Path(file).resolve().as_uri() + '?mode=ro', uri=True)
+        else:
+            self.conn = sqlite3.connect(file)
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+                CREATE TABLE IF NOT EXISTS words (symbol INTEGER PRIMARY KEY, word TEXT);
+                CREATE TABLE IF NOT EXISTS nodes (tree TEXT, id INTEGER, parent INTEGER, symbol INTEGER,
+                                                  count INTEGER, usage INTEGER, PRIMARY KEY (tree, id)) WITHOUT ROWID;
+            """)
+        self.cache = {}
+        self.saved = {}
+        for key, value in self.conn.execute('SELECT key, value FROM meta'):
+            self.cache[key] = pickle.loads(value)
+        for key in self.TREES:
+            rows = self.conn.execute('SELECT id, parent, symbol, count, usage FROM nodes WHERE tree = ? ORDER BY id', (key,))
+            tree = ArrayTree.from_rows(rows)
+            if len(tree) > 1:
+                self.track(key, tree, len(tree))
+        words = [word for word, in self.conn.execute('SELECT word FROM words ORDER BY symbol')]
+        if words:
+            self.cache['dictionary'] = Dictionary(words)
+            self.saved['dictionary'] = len(words)
+
+    def track(self, key, tree, saved):
+        tree.dirty = set()
+        self.cache[key] = tree
+        self.saved[key] = saved
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        if self.readonly:
+            self.cache[key] = value  # For as long as it's open, sync never writes it
+        elif key in self.TREES:
+            if not isinstance(value, ArrayTree):
+                raise ValueError('The sqlite store can only hold array engine trees')
+            self.conn.execute('DELETE FROM nodes WHERE tree = ?', (key,))
+            self.track(key, value, 0)
+        elif key == 'dictionary':
+            self.conn.execute('DELETE FROM words')
+            self.cache[key] = value
+            self.saved[key] = 0
+        else:
+            self.cache[key] = value
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def setdefault(self, key, default=None):
+        if key not in self.cache:
+            self[key] = default
+        return self.cache[key]
+
+    def sync(self):
+        if self.readonly:
+            return
+        with self.conn:
+            for key in self.TREES:
+                tree = self.cache.get(key)
+                if tree is None:
+                    continue
+                saved = self.saved[key]
+                self.conn.executemany('UPDATE nodes SET count = ?, usage = ? WHERE tree = ? AND id = ?',
+                                      [(tree.counts[id], tree.usages[id], key, id) for id in tree.dirty if id < saved])
+                self.conn.executemany('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                                      [(key, id, tree.parents[id], tree.symbols[id], tree.counts[id], tree.usages[id])
+                                       for id in range(saved, len(tree))])
+                tree.dirty.clear()
+                self.saved[key] = len(tree)
+            dictionary = self.cache.get('dictionary')
+            if dictionary is not None:
+                saved = self.saved['dictionary']
+                self.conn.executemany('INSERT INTO words VALUES (?, ?)', enumerate(dictionary[saved:], saved))
+                self.saved['dictionary'] = len(dictionary)
+            self.conn.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                  [(key, pickle.dumps(value)) for key, value in self.cache.items()
+                                   if key not in self.TREES and key != 'dictionary'])
+
+    def compact(self):
+        self.sync()
+        self.conn.execute('VACUUM')
+
+    def close(self):
+        self.sync()
+        self.conn.close()
+
+
+class Journal(object):
+    """Append-only log of the phrases learned since the brain was last synced.
+
+    The first line holds the number of the checkpoint the journal follows, each
+    further line is one tokenized phrase as JSON.  Lines are flushed to the OS as
+    they are written, so they survive the process dying; fsync is batched every
+    JOURNAL_SYNC_PHRASES phrases or JOURNAL_SYNC_SECONDS seconds.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.fp = None
+        self.pending = 0
+        self.synced_at = time()
+
+    def read(self):
+        """Return the journal's checkpoint and phrases, dropping a torn last line"""
+        try:
+            with io.open(self.file, 'rb') as fp:
+                data = fp.read()
+        except IOError:
+            return None, []
+        checkpoint, entries, offset = None, [], 0
+        for line in data.splitlines(True):
+            if not line.endswith(b'\n'):
+                break
+            try:
+                value = json.loads(line.decode('utf-8'))
+            except ValueError:
+                break
+            if checkpoint is None:
+                if not isinstance(value, dict):
+                    break
+                checkpoint = value.get('checkpoint')
+            else:
+                entries.append(value)
+            offset += len(line)
+        if offset < len(data):
+            with io.open(self.file, 'r+b') as fp:
+                fp.truncate(offset)
+        return checkpoint, entries
+
+    def open(self):
+        if self.fp is None:
+            self.fp = io.open(self.file, 'a', encoding='utf-8')
+        return self.fp
+
+    def append(self, words):
+        fp = self.open()
+        fp.write(json.dumps(words, ensure_ascii=False) + '\n')
+        fp.flush()
+        self.pending += 1
+        if self.pending >= JOURNAL_SYNC_PHRASES or time() - self.synced_at >= JOURNAL_SYNC_SECONDS:
+            self.fsync()
+
+    def fsync(self):
+        if self.fp is not None and self.pending:
+            os.fsync(self.fp.fileno())
+        self.pending = 0
+        self.synced_at = time()
+
+    def reset(self, checkpoint):
+        """Start an empty journal following checkpoint"""
+        self.close()
+        with io.open(self.file, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps({'checkpoint': checkpoint}) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+
+    def close(self):
+        if self.fp is not None:
+            self.fsync()
+            self.fp.close()
+            self.fp = None
+
+
+KeySymbols = namedtuple('KeySymbols', 'plain every seeds')
+SearchStats = namedtuple('SearchStats', 'candidates surprise elapsed cache_hits cache_misses')
+TrainingProgress = namedtuple('TrainingProgress', 'offset size lines lines_per_second tokens_per_second')
+Compaction = namedtuple('Compaction', 'nodes_before nodes_after words_before words_after')
+
+
+class ShelveStore(shelve.DbfilenameShelf):
+    """The default brain storage, a writeback shelve whose sync keeps its cache.
+
+    A plain shelve forgets its cached objects on sync, but Brain goes on
+    changing those same trees and dictionary, so the next sync would miss them.
+    Read-only, the database is opened with the 'r' flag and nothing is cached
+    or written back.
+    """
+
+    def __init__(self, file, readonly=False):
+        shelve.DbfilenameShelf.__init__(self, file, flag='r' if readonly else 'c', writeback=not readonly)
+        self.file = file
+        self.readonly = readonly
+
+    def sync(self):
+        if self.readonly:
+            return
+        if self.writeback and self.cache:
+            self.writeback = False
+            for key, entry in self.cache.items():
+                self[key] = entry
+            self.writeback = True
+        if hasattr(self.dict, 'sync'):
+            self.dict.sync()
+
+    def compact(self):
+        """Copy every value into a new file and swap it in, leaving behind the space old values took up"""
+        self.sync()
+        module = importlib.import_module(dbm.whichdb(self.file))
+        temp = self.file + '.compact'
+        copy = module.open(temp, 'n')
+        try:
+            for key in self.dict.keys():
+                copy[key] = self.dict[key]
+        finally:
+            copy.close()
+        self.dict.close()
+        # Depending on the dbm, a database is one file or several with these suffixes
+        for suffix in ('', '.db', '.dat', '.dir', '.bak', '.pag'):
+            if os.path.exists(temp + suffix):
+                os.replace(temp + suffix, self.file + suffix)
+        self.dict = module.open(self.file, 'w')
+
+    def close(self):
+        shelve.DbfilenameShelf.close(self)
+        self.cache = {}
+
+
+class Snapshot(object):
+    """A brain snapshot file, mapped into memory.
+
+    The file starts with SNAPSHOT_MAGIC, the format version and the length of a
+    pickled header, which holds the brain's other keys and where each section
+    sits.  Then come the sections, 8-byte aligned: the five node arrays and two
+    sorted child arrays of each trie (see MappedTree), and the dictionary as the
+    offsets of each word into one UTF-8 string table.  Arrays are read in place,
+    so pages only come off disk as replies reach them, and processes mapping the
+    same file share them.
+    """
+
+    HEADER = struct.Struct('<8sII')
+    TREE_SECTIONS = ('symbols', 'counts', 'usages', 'firsts', 'sizes', 'sorted_symbols', 'sorted_children')
+
+    def __init__(self, file):
+        with open(file, 'rb') as fp:
+            self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size = self.HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a brain snapshot: %s' % file)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('This snapshot has an incompatible version: %d != %d' % (version, SNAPSHOT_VERSION))
+        header = pickle.loads(self.map[self.HEADER.size:self.HEADER.size + size])
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('This snapshot was written on a %s-endian machine' % header['byteorder'])
+        self.meta = header['meta']
+        self.sections = header['sections']
+        self.start = align(self.HEADER.size + size)
+
+    def section(self, name):
+        offset, typecode, length = self.sections[name]
+        start = self.start + offset
+        view = memoryview(self.map)[start:start + length * array(typecode).itemsize]
+        return view.cast(typecode)
+
+    def tree(self, key):
+        return MappedTree(*[self.section('%s.%s' % (key, name)) for name in self.TREE_SECTIONS])
+
+    def words(self):
+        offsets = self.section('words.offsets')
+        text = self.section('words.text')
+        return [str(text[offsets[i]:offsets[i + 1]], 'utf-8') for i in range(len(offsets) - 1)]
+
+    @classmethod
+    def write(cls, file, trees, words, meta):
+        """Write trees (a dict of key -> tree of any engine), the dictionary words and the other keys to file"""
+        sections = []
+        for key, tree in trees.items():
+            sections.extend(('%s.%s' % (key, name), data) for name, data in zip(cls.TREE_SECTIONS, flatten_tree(tree)))
+        text = [word.encode('utf-8') for word in words]
+        offsets = array('I', [0])
+        offsets.extend(accumulate(len(word) for word in text))
+        sections.append(('words.offsets', offsets))
+        sections.append(('words.text', array('B', b''.join(text))))
+        table = {}
+        offset = 0
+        for name, data in sections:
+            table[name] = (offset, data.typecode, len(data))
+            offset = align(offset + len(data) * data.itemsize)
+        header = pickle.dumps({'byteorder': sys.byteorder, 'meta': meta, 'sections': table})
+        temp = '%s.%d.tmp' % (file, os.getpid())
+        with open(temp, 'wb') as fp:
+            fp.write(cls.HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(header)))
+            fp.write(header)
+            fp.write(b'\0' * (align(fp.tell()) - fp.tell()))
+            for name, data in sections:
+                data.tofile(fp)
+                fp.write(b'\0' * (align(fp.tell()) - fp.tell()))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(temp, file)
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def sort_edges(parents, symbols, start, end):
+    """Sorted (parent << 32 | symbol) keys of nodes start to end of an ArrayTree, and the node ids"""
+    ids = numpy.arange(start, end, dtype=numpy.int64)
+    keys = (numpy.frombuffer(parents, numpy.uintc)[start:end].astype(numpy.int64) << 32 |
+            numpy.frombuffer(symbols, numpy.uintc)[start:end])
+    order = numpy.argsort(keys, kind='stable')
+    return keys[order], ids[order]
+
+
+def child_slots(firsts, sizes, nodes):
+    """Where the edges of nodes (numpy arrays of an ArrayTree's firsts and sizes, and of node ids) are, every
+    node's in turn, and which of nodes each belongs to"""
+    lengths = sizes[nodes].astype(numpy.int64)
+    owners = numpy.repeat(numpy.arange(len(nodes)), lengths)
+    starts = firsts[nodes].astype(numpy.int64) - (numpy.cumsum(lengths) - lengths)
+    return numpy.repeat(starts, lengths) + numpy.arange(lengths.sum()), owners
+
+
+def flatten_tree(tree):
+    """Number the nodes of tree (any engine) breadth first, return the arrays a MappedTree reads"""
+    symbols, counts, usages = array('I', [tree.symbol]), array('I', [tree.count]), array('I', [tree.usage])
+    firsts, sizes = array('I'), array('I')
+    queue = deque([tree])
+    while queue:
+        node = queue.popleft()
+        firsts.append(len(symbols))
+        sizes.append(len(node.children))
+        for child in node.children:
+            symbols.append(child.symbol)
+            counts.append(child.count)
+            usages.append(child.usage)
+            queue.append(child)
+    sorted_symbols, sorted_children = array('I'), array('I')
+    for first, size in zip(firsts, sizes):
+        children = sorted(range(first, first + size), key=symbols.__getitem__)
+        sorted_symbols.extend(symbols[child] for child in children)
+        sorted_children.extend(children)
+    return symbols, counts, usages, firsts, sizes, sorted_symbols, sorted_children
+
+
+class SnapshotStore(object):
+    """Brain storage opened from a snapshot, see Brain.export_snapshot.
+
+    The tries are mapped from the file rather than loaded, and whatever the
+    brain learns goes into OverlayTrees in memory on top of them.  Nothing is
+    ever written back to the snapshot; the journal keeps what was learned.
+    Read-only, the MappedTrees are handed out bare, so the only memory of its
+    own a process needs is the dictionary.
+    """
+
+    def __init__(self, file, readonly=False):
+        snapshot = Snapshot(file)
+        self.cache = dict(snapshot.meta)
+        for key in ('forward', 'backward'):
+            tree = snapshot.tree(key)
+            self.cache[key] = tree if readonly else OverlayTree(tree)
+        self.cache['dictionary'] = Dictionary(snapshot.words())
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def __getitem__(self, key):
+        return self.cache[key]
+
+    def __setitem__(self, key, value):
+        self.cache[key] = value
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def setdefault(self, key, default=None):
+        return self.cache.setdefault(key, default)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def compact(self):
+        raise ValueError('A snapshot cannot be compacted, compact the brain it came from and export it again')
+
+
+class MemoryStore(dict):
+    """Brain storage that is never written anywhere, for scratch brains such as bulk training workers"""
+
+    def __init__(self, file=None):
+        dict.__init__(self)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+    def compact(self):
+        pass
+
+
+STORES = {'shelve': ShelveStore, 'sqlite': SQLiteStore, 'snapshot': SnapshotStore, 'memory': MemoryStore}
+
+
 class Brain(object):
 
-    def __init__(self, order, file, timeout):
+    def __init__(self, order, file, timeout, engine=None, store=None, journal=True, workers=DEFAULT_WORKERS,
+                 candidates=None, surprise=None, deadline=None, readonly=False):
         #mod = __import__("dbm.gnu")
         self.timeout = timeout
+        if candidates is not None and candidates < 1:
+            raise ValueError('A reply search needs at least one candidate')
+        self.candidates = candidates
+        self.surprise = surprise
+        self.deadline = deadline
+        self.last_search = None
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('Parallel reply search needs the fork start method')
+        self.workers = workers
+        self.pool = None
+        self.learned = []
+        self.flags = bytearray()
+        self.flags_stamp = None
+        self.transitions = TransitionCache()
+        self.contexts = []  # Spare Contexts, see get_context
         #self.db = shelve.Shelf(mod.open(file, writeback=True))
-        self.db = shelve.open(file, writeback=True)
+        if store is None:
+            store = self.detect_store(file)
+        if store not in STORES:
+            raise ValueError('Unknown brain store: %s' % store)
+        if store == 'sqlite':
+            if engine is None:
+                engine = 'array'
+            elif engine != 'array':
+                raise ValueError('The sqlite store needs the array engine')
+        elif store == 'snapshot' and not readonly:
+            if engine is None:
+                engine = 'tree'
+            elif engine != 'tree':
+                raise ValueError('A snapshot learns into tree engine overlays')
+        self.store = store
+        self.readonly = readonly
+        if readonly:
+            if store == 'memory':
+                raise ValueError('A memory brain cannot be read-only')
+            # Nothing is ever written back, and there's no journal: a brain file is read as it was last synced
+            journal = False
+            if store == 'snapshot':
+                # The mapped trees are used as they are, with no overlay to learn into
+                engine = 'array'
+            self.db = STORES[store](file, readonly=True)
+        else:
+            self.db = STORES[store](file)
         if self.db.setdefault('api', API_VERSION) != API_VERSION:
             raise ValueError('This brain has an incompatible api version: %d != %d' % (self.db['api'], API_VERSION))
         if self.db.setdefault('order', order) != order:
             raise ValueError('This brain already has an order of %d' % self.db['order'])
-        self.forward = self.db.setdefault('forward', Tree())
-        self.backward = self.db.setdefault('backward', Tree())
+        if engine is None:
+            engine = self.db.get('engine', DEFAULT_ENGINE)
+        if engine not in ENGINES:
+            raise ValueError('Unknown brain engine: %s' % engine)
+        self.forward = self.db.setdefault('forward', ENGINES[engine]())
+        self.backward = self.db.setdefault('backward', ENGINES[engine]())
+        if not isinstance(self.forward, ENGINES[engine]):
+            if engine != 'array':
+                raise ValueError('This brain already uses the %s engine' % self.db['engine'])
+            # Older brains are made of Tree objects, convert them in place (only in memory, read-only)
+            self.forward = ArrayTree.from_tree(self.forward)
+            self.backward = ArrayTree.from_tree(self.backward)
+            if not readonly:
+                self.db['forward'], self.db['backward'] = self.forward, self.backward
+        if not readonly:
+            self.db['engine'] = engine
         self.dictionary = self.db.setdefault('dictionary', Dictionary())
         self.error_symbol = self.dictionary.add_word(ERROR_WORD)
         self.end_symbol = self.dictionary.add_word(END_WORD)
@@ -156,170 +1498,331 @@ class Brain(object):
         self.auxwords = self.db.setdefault('auxwords', Dictionary(DEFAULT_AUXWORDS))
         self.swapwords = self.db.setdefault('swapwords', DEFAULT_SWAPWORDS)
         self.closed = False
+        self.journal = None
+        if journal:
+            self.journal = Journal(file + '.journal')
+            self.replay_journal()
 
     @property
     def order(self):
         return self.db['order']
 
+    @staticmethod
+    def detect_store(file):
+        try:
+            with open(file, 'rb') as fp:
+                magic = fp.read(16)
+                if magic == b'SQLite format 3\x00':
+                    return 'sqlite'
+                if magic.startswith(SNAPSHOT_MAGIC):
+                    return 'snapshot'
+        except IOError:
+            pass
+        return DEFAULT_STORE
+
     @staticmethod
     def get_words_from_phrase(phrase):
         phrase = phrase.upper()
         words = []
         if phrase:
-            offset = 0
-
-            def isalpha_extended(str):
-                if str.isalpha():
-                    return True
-                else:
-                    uni = re.compile(r"([\p{L}]+)", re.UNICODE)
-                    if (uni.search(str) is not None):
-                        return True
-                    else:
-                        return False
-
-            def boundary(string, position):
-                if position == 0:
-                    boundary = False
-                elif position == len(string):
-                    boundary = True
-                elif (string[position] == "'" and
-                    isalpha_extended(string[position - 1]) and
-                    isalpha_extended(string[position + 1])):
-                    boundary = False
-                elif (position > 1 and
-                    string[position - 1] == "'" and
-                    isalpha_extended(string[position - 2]) and
-                    isalpha_extended(string[position])):
-                    boundary = False
-                elif (isalpha_extended(string[position]) and
-                    not isalpha_extended(string[position - 1])):
-                    boundary = True
-                elif (not isalpha_extended(string[position]) and
-                    isalpha_extended(string[position - 1])):
-                    boundary = True
-                elif string[position].isdigit() != string[position -1].isdigit():
-                    boundary = True
-                else:
-                    boundary = False
-                return boundary
-
-            colon = False
-
-            while True:
-                if offset < len(phrase) and phrase[offset] == ":":
-                    colon = True
-                elif offset > 0 and phrase[offset-1] == ":" and not isalpha_extended(phrase[offset]):
-                    colon = False
-                if boundary(phrase, offset):
-                    word, phrase = phrase[:offset], phrase[offset:]
-                    words.append(word)
-                    if not phrase:
-                        break
-                    offset = 0
-                else:
-                    offset += 1
+            words = WORD_REGEX.findall(phrase)
             if words[-1][0].isalnum():           # Add a period at the end
                 words.append('.')
-            elif words[-1][-1] == ':' and colon: # If the last character is a colon preceded between an alphanumeric string preceded by another colon (i.e. an emote)
+            elif words[-1][-1] == ':' and Brain.ends_with_emote(phrase):
                 words[-1] = ':'                  # Preserve the emote
             elif words[-1][-1] not in '!.?':
                 words[-1] = '.'                  # Everything else gets replaced by a period
         return words
 
-    def communicate(self, phrase, learn=True, reply=True):
+    @staticmethod
+    def ends_with_emote(phrase):
+        # The final colon closes an emote if the colon before it opens a word, like :SMILE:
+        i = phrase.rfind(':', 0, len(phrase) - 1)
+        return i >= 0 and LETTER_REGEX.match(phrase, i + 1) is not None
+
+    def communicate(self, phrase, learn=True, reply=True, journal=True, count=None, timeout=None):
         words = self.get_words_from_phrase(phrase)
         if learn:
             self.learn(words)
+            if journal and self.journal is not None and len(words) > self.order:
+                self.journal.append(words)
         if reply:
-            return self.get_reply(words)
-
-    def get_context(self, tree):
-
-        class Context(dict):
-
-            def __enter__(context):
-                context.used_key = False
-                context[0] = tree
-                return context
-
-            def __exit__(context, *exc_info):
-                context.update(self.end_symbol)
-
-            @property
-            def root(context):
-                return context[0]
-
-            def update(context, symbol):
-                for i in range(self.order + 1, 0, -1):
-                    node = context.get(i - 1)
-                    if node is not None:
-                        context[i] = node.add_symbol(symbol)
-
-            def seed(context, keys):
-                if keys:
-                    i = random.randrange(len(keys))
-                    for key in keys[i:] +  keys[:i]:
-                        if key not in self.auxwords:
-                            try:
-                                return self.dictionary.index(key)
-                            except ValueError:
-                                pass
-                if context.root.children:
-                    return random.choice(context.root.children).symbol
-                return 0
-
-            def babble(context, keys, replies):
-                for i in range(self.order + 1):
-                    if context.get(i) is not None:
-                        node = context[i]
-                if not node.children:
-                    return 0
-                i = random.randrange(len(node.children))
-                count = random.randrange(node.usage)
-                symbol = 0
-                while count >= 0:
-                    symbol = node.children[i].symbol
-                    word = self.dictionary[symbol]
-                    if word in keys and (context.used_key or word not in self.auxwords):
-                        context.used_key = True
-                        break
-                    count -= node.children[i].count
-                    if i >= len(node.children) - 1:
-                        i = 0
-                    else:
-                        i = i + 1
-                return symbol
-
-        return Context()
+            if count is None:
+                return self.get_reply(words, timeout)
+            return self.get_replies(words, count, timeout)
+
+    def get_context(self, tree, learn=False):
+        """A Context walking tree, reused from the ones earlier walks were done with"""
+        if self.contexts:
+            context = self.contexts.pop()
+        else:
+            context = Context(self)
+        context.tree = tree
+        context.learn = learn
+        return context
 
     def learn(self, words):
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        self.transitions.clear()
         if len(words) > self.order:
-            with self.get_context(self.forward) as context:
+            with self.get_context(self.forward, learn=True) as context:
                 for word in words:
                     context.update(self.dictionary.add_word(word))
-            with self.get_context(self.backward) as context:
+            with self.get_context(self.backward, learn=True) as context:
                 for word in reversed(words):
                     context.update(self.dictionary.index(word))
+            if self.pool is not None:
+                self.learned.append(words)
+                if len(self.learned) >= POOL_REFRESH_PHRASES:
+                    self.close_pool()
+
+    def merge(self, forward, backward, words):
+        """Add what another brain learned, its ArrayTrees and dictionary words, as if it had been learned here"""
+        symbols = [self.dictionary.add_word(word) for word in words]
+        forward.merge_into(self.forward, symbols)
+        backward.merge_into(self.backward, symbols)
+        self.transitions.clear()
+        # Search workers can't replay a merge, fork new ones
+        self.close_pool()
+
+    def compact(self, threshold=COMPACT_MIN_COUNT):
+        """Forget contexts seen fewer than threshold times and words nothing uses any more, then rewrite the
+        brain file without the gaps.
+
+        The root's children are always kept, so every word learned can still be used.  Returns a Compaction.
+        """
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        if self.store == 'snapshot':
+            self.db.compact()
+        self.sync()
+        before = self.count_nodes()
+        used = set([self.error_symbol, self.end_symbol])
+        for tree in (self.forward, self.backward):
+            for node, kept in prune_walk(tree, threshold):
+                used.update(child.symbol for child in kept)
+        symbols = {}
+        words = Dictionary()
+        for symbol, word in enumerate(self.dictionary):
+            if symbol in used:
+                symbols[symbol] = len(words)
+                words.append(word)
+        compaction = Compaction(before, 0, len(self.dictionary), len(words))
+        self.forward = self.db['forward'] = prune_tree(self.forward, threshold, symbols)
+        self.backward = self.db['backward'] = prune_tree(self.backward, threshold, symbols)
+        self.dictionary = self.db['dictionary'] = words
+        self.error_symbol = self.dictionary.add_word(ERROR_WORD)
+        self.end_symbol = self.dictionary.add_word(END_WORD)
+        # Search workers and the transition cache hold the old trees
+        self.close_pool()
+        self.learned = []
+        self.transitions.clear()
+        self.sync()
+        self.db.compact()
+        return compaction._replace(nodes_after=self.count_nodes())
+
+    def count_nodes(self):
+        return sum(1 for tree in (self.forward, self.backward) for node in prune_walk(tree, 0))
+
+    def train(self, file, workers=None, checkpoint=TRAIN_CHECKPOINT_LINES, progress=None):
+        """Learn every line of file, carrying on from where an interrupted training of the same file stopped.
+
+        Every checkpoint lines the brain is synced together with the byte offset and line count reached, and
+        progress (if given) is called with a TrainingProgress.  With more than one worker, runs of lines are
+        learned in worker processes and then merged.
+        """
+        if self.store == 'snapshot':
+            raise ValueError('Train the brain the snapshot came from and export it again')
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        if workers is None:
+            workers = self.workers
+        if workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            raise ValueError('Parallel training needs the fork start method')
+        file = os.path.abspath(file)
+        size = os.path.getsize(file)
+        offset = lines = 0
+        record = self.db.get('training')
+        if record is not None and record['file'] == file and record['offset'] <= size:
+            offset, lines = record['offset'], record['lines']
+        basetime = time()
+        first = saved = lines
+        tokens = 0
+
+        def report(offset):
+            if progress is not None:
+                elapsed = max(time() - basetime, 1e-9)
+                progress(TrainingProgress(offset, size, lines, (lines - first) / elapsed, tokens / elapsed))
 
-    def get_reply(self, words):
+        done = offset
+        try:
+            if workers < 2:
+                with open(file, 'rb') as fp:
+                    fp.seek(offset)
+                    for offset, phrases in read_phrases(fp, size):
+                        for phrase in phrases:
+                            words = self.get_words_from_phrase(phrase)
+                            self.learn(words)
+                            tokens += len(words)
+                        lines += 1
+                        done = offset
+                        if lines - saved >= checkpoint:
+                            self.db['training'] = {'file': file, 'offset': offset, 'lines': lines}
+                            self.sync()
+                            saved = lines
+                            report(offset)
+            else:
+                # Cut the rest of the file at line ends, into chunks small enough to checkpoint between
+                step = max(1, min(TRAIN_CHUNK_BYTES, (size - offset) // (workers * 4)))
+                offsets = [offset]
+                with open(file, 'rb') as fp:
+                    while offsets[-1] < size:
+                        fp.seek(offsets[-1] + step - 1)
+                        fp.readline()
+                        offsets.append(min(fp.tell(), size))
+                chunks = [(file, start, end, self.order) for start, end in zip(offsets, offsets[1:])]
+                # Merging into a Tree goes node by node, so chunks for one are gathered in an array brain, which
+                # merges them in bulk, and that is merged in once per checkpoint
+                gather = numpy is not None and not isinstance(self.forward, ArrayTree)
+                batch, batched = self, 0
+                with multiprocessing.get_context('fork').Pool(workers) as pool:
+                    # imap hands the chunks back in order, so merging as they come keeps the phrases in file order
+                    for end, (forward, backward, words, chunk_lines, chunk_tokens) in zip(
+                            offsets[1:], pool.imap(train_in_worker, chunks)):
+                        if gather and batch is self:
+                            batch = Brain(self.order, None, None, engine='array', store='memory', journal=False)
+                            batch.closed = True  # A scratch brain has nothing to save
+                        batch.merge(forward, backward, words)
+                        batched += chunk_lines
+                        tokens += chunk_tokens
+                        if batch is not self and lines + batched - saved < checkpoint and end < size:
+                            continue
+                        if batch is not self:
+                            self.merge(batch.forward, batch.backward, list(batch.dictionary))
+                            batch = self
+                        lines += batched
+                        batched = 0
+                        done = end
+                        if lines - saved >= checkpoint:
+                            self.db['training'] = {'file': file, 'offset': end, 'lines': lines}
+                            self.sync()
+                            saved = lines
+                            report(end)
+        except BaseException:
+            # The brain is saved on the way out too, so point the record at what it has learned by now rather than
+            # at the last checkpoint, or resuming would learn the lines in between twice
+            self.db['training'] = {'file': file, 'offset': done, 'lines': lines}
+            raise
+        self.db['training'] = None
+        report(size)
+
+    def get_reply(self, words, timeout=None):
+        return self.get_replies(words, 1, timeout)[0]
+
+    def get_replies(self, words, count, timeout=None):
+        """Up to count different replies from a single search, most surprising first"""
+        basetime = time()
+        deadline = None
+        if self.deadline is not None:
+            deadline = basetime + self.deadline
+        if timeout is None:
+            timeout = self.timeout
+        self.transitions.reset()
         keywords = self.make_keywords(words)
-        dummy_reply = self.generate_replywords()
+        dummy_reply = self.generate_replywords(deadline=deadline)
         if not dummy_reply or words == dummy_reply:
             output = self.get_words_from_phrase("I don't know enough to answer yet!")
         else:
             output = dummy_reply
 
-        max_surprise = -1.0
+        if self.workers > 1:
+            candidates = self.candidates
+            if candidates is not None:
+                candidates = -(-candidates // self.workers)
+            results = self.get_pool().map(search_in_worker, [(keywords, candidates, deadline, timeout, count, self.learned)]
+                                          * self.workers)
+        else:
+            results = [self.search(keywords, self.candidates, deadline, timeout, count) +
+                       (self.transitions.hits, self.transitions.misses)]
+        found = []
+        evaluated = hits = misses = 0
+        for best, tried, worker_hits, worker_misses in results:
+            found.extend(best)
+            evaluated += tried
+            hits += worker_hits
+            misses += worker_misses
+        found.sort(key=lambda result: result[0], reverse=True)
+        replies = []
+        for surprise, reply in found:
+            reply = u''.join(reply).capitalize()
+            if reply not in replies:
+                replies.append(reply)
+        if not replies:
+            replies.append(u''.join(output).capitalize())
+        self.last_search = SearchStats(evaluated, found[0][0] if found else -1.0, time() - basetime, hits, misses)
+
+        return replies[:count]
+
+    def search(self, keywords, candidates=None, deadline=None, timeout=None, keep=1):
+        """Generate and score replies, return the keep most surprising different ones and how many were tried.
+
+        The replies come as (surprise, words) pairs, best first.  Stops after candidates replies if given, else
+        after timeout (or self.timeout) seconds; earlier once keep replies reach self.surprise, and as soon as the
+        deadline passes, even halfway through a reply.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        keysymbols = self.get_keysymbols(keywords)
+        keyset = frozenset(keywords)
+        batch = SCORE_BATCH if self.batch_scoring else 1
+        best = []
+        count = 0
         basetime = time()
-        while time() - basetime < self.timeout:
-            reply = self.generate_replywords(keywords)
-            surprise = self.evaluate_reply(keywords, reply)
-            if reply and surprise > max_surprise and reply != keywords:
-                max_surprise = surprise
-                output = reply
-
-        return u''.join(output).capitalize()
+        done = False
+        while not done:
+            if self.surprise is not None and len(best) == keep and best[-1][0] >= self.surprise:
+                break
+            replies = []
+            while len(replies) < batch:
+                if candidates is not None:
+                    if count + len(replies) >= candidates:
+                        done = True
+                        break
+                elif time() - basetime >= timeout:
+                    done = True
+                    break
+                reply = self.generate_replywords(keywords, deadline, keysymbols)
+                if reply is None:
+                    done = True
+                    break
+                replies.append(reply)
+            for reply, surprise in zip(replies, self.evaluate_replies(keyset, replies)):
+                if self.surprise is not None and len(best) == keep and best[-1][0] >= self.surprise:
+                    break
+                count += 1
+                if (reply and reply != keywords and (len(best) < keep or surprise > best[-1][0]) and
+                    all(reply != other for score, other in best)):
+                    # Ties keep the reply found first
+                    position = len(best)
+                    while position and best[position - 1][0] < surprise:
+                        position -= 1
+                    best.insert(position, (surprise, reply))
+                    del best[keep:]
+        return best, count
+
+    def get_pool(self):
+        """Worker processes forked from this brain, each searching its own copy of it"""
+        if self.pool is None:
+            self.learned = []
+            self.pool = multiprocessing.get_context('fork').Pool(self.workers, init_search_worker, (self,))
+        return self.pool
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+            self.learned = []
 
     def evaluate_reply(self, keys, words):
         state = {'num': 0, 'entropy': 0.0}
@@ -331,18 +1834,10 @@ class Brain(object):
                         symbol = self.dictionary.index(word)
                         context.update(symbol)
                         if word in keys:
-                            prob = 0.0
-                            count = 0
                             state['num'] += 1
-                            for j in range(self.order):
-                                node = context.get(j)
-                                if node is not None:
-                                    child = node.get_child(symbol, add=False)
-                                    if child:
-                                        prob += float(child.count) / node.usage
-                                    count += 1
-                            if count:
-                                state['entropy'] -= math.log(prob / count)
+                            probability = context.probability(symbol)
+                            if probability is not None:
+                                state['entropy'] -= math.log(probability)
 
             evaluate(self.forward, words)
             evaluate(self.backward, reversed(words))
@@ -353,73 +1848,225 @@ class Brain(object):
                 state['entropy'] /= state['num']
         return state['entropy']
 
-    def generate_replywords(self, keys=None):
+    @property
+    def batch_scoring(self):
+        """Whether evaluate_replies walks the trees for many replies at once, which takes numpy and ArrayTrees"""
+        return numpy is not None and isinstance(self.forward, ArrayTree) and isinstance(self.backward, ArrayTree)
+
+    def evaluate_replies(self, keys, replies):
+        """evaluate_reply for each of replies, giving exactly the same surprises.
+
+        With batch_scoring the context nodes of every word of every reply are found level by level with numpy,
+        then each keyword's probability is summed in the same order evaluate_reply sums it.  The logs are still
+        taken and added up one by one, numpy's log can round differently.
+        """
+        if not replies or not self.batch_scoring:
+            return [self.evaluate_reply(keys, words) for words in replies]
+        lookup = self.dictionary.get_lookup()
+        lengths = numpy.array([len(words) for words in replies], numpy.int64)
+        symbols = numpy.array([lookup[word] for words in replies for word in words], numpy.int64)
+        iskey = numpy.isin(symbols, [lookup[word] for word in keys if word in lookup])
+        ends = numpy.cumsum(lengths)
+        owners = numpy.repeat(numpy.arange(len(replies)), lengths)
+        positions = numpy.arange(len(symbols)) - (ends - lengths)[owners]
+        backward = (ends[owners] - 1) - positions  # Each reply back to front
+        entropies = [0.0] * len(replies)
+        nums = [0] * len(replies)
+        for tree, order in ((self.forward, numpy.arange(len(symbols))), (self.backward, backward)):
+            walked = symbols[order]
+            first = positions == 0
+            counts = numpy.frombuffer(tree.counts, numpy.uintc)
+            usages = numpy.frombuffer(tree.usages, numpy.uintc)
+            # levels[i] holds the context node i words deep after each word, the root being 0 deep
+            levels = [numpy.zeros(len(walked), numpy.int64)]
+            for i in range(1, self.order):
+                parents = numpy.roll(levels[-1], 1)
+                if i > 1:
+                    parents[first] = -1
+                levels.append(tree.find_children(parents, walked))
+            keyed = numpy.flatnonzero(iskey[order])
+            prob = numpy.zeros(len(keyed))
+            count = numpy.zeros(len(keyed), numpy.int64)
+            for level in levels:
+                nodes = level[keyed]
+                children = tree.find_children(nodes, walked[keyed])
+                found = children >= 0
+                term = numpy.zeros(len(keyed))
+                term[found] = counts[children[found]] / usages[nodes[found]].astype(numpy.float64)
+                prob += term
+                count += nodes >= 0
+            del counts, usages  # Views that would stop the tree's arrays from growing
+            for owner, ratio in zip(owners[keyed].tolist(), (prob / count).tolist()):
+                entropies[owner] -= math.log(ratio)
+                nums[owner] += 1
+        for i, num in enumerate(nums):
+            if num >= 8:
+                entropies[i] /= math.sqrt(num - 1)
+            if num >= 16:
+                entropies[i] /= num
+        return entropies
+
+    def generate_replywords(self, keys=None, deadline=None, keysymbols=None):
+        """Babble a reply around keys, or return None if the deadline passes first"""
         if keys is None:
             keys = []
-        replies = []
+        if keysymbols is None:
+            keysymbols = self.get_keysymbols(keys)
+        # Babbled as symbols, the backward half prepended, and only turned into words once it's done
+        symbols = deque()
         with self.get_context(self.forward) as context:
             start = True
             while True:
                 if start:
-                    symbol = context.seed(keys)
+                    symbol = context.seed(keysymbols.seeds)
                     start = False
                 else:
-                    symbol = context.babble(keys, replies)
+                    symbol = context.babble(keysymbols, symbols)
                 if symbol in (self.error_symbol, self.end_symbol):
                     break
-                replies.append(self.dictionary[symbol])
+                if deadline is not None and time() >= deadline:
+                    return None
+                symbols.append(symbol)
                 context.update(symbol)
         with self.get_context(self.backward) as context:
-            if replies:
-                for i in range(min([(len(replies) - 1), self.order]), -1, -1):
-                    context.update(self.dictionary.index(replies[i]))
+            if symbols:
+                for i in range(min([(len(symbols) - 1), self.order]), -1, -1):
+                    context.update(symbols[i])
             while True:
-                symbol = context.babble(keys, replies)
+                symbol = context.babble(keysymbols, symbols)
                 if symbol in (self.error_symbol, self.end_symbol):
                     break
-                replies.insert(0, self.dictionary[symbol])
+                if deadline is not None and time() >= deadline:
+                    return None
+                symbols.appendleft(symbol)
                 context.update(symbol)
 
-        return replies
+        return [self.dictionary[symbol] for symbol in symbols]
+
+    def get_flags(self):
+        """FLAG_BANNED and FLAG_AUX of every symbol's word, indexed by symbol.
+
+        Rebuilt when the dictionary or word lists are replaced or changed by anything but append(); words the
+        dictionary gains are flagged as they show up.
+        """
+        stamp = (self.dictionary, self.dictionary.version, self.banwords, self.banwords.version, len(self.banwords),
+                 self.auxwords, self.auxwords.version, len(self.auxwords))
+        if self.flags_stamp is None or any(new is not old and new != old for new, old in zip(stamp, self.flags_stamp)):
+            self.flags = bytearray()
+            self.flags_stamp = stamp
+        flags = self.flags
+        for word in self.dictionary[len(flags):]:
+            flags.append((FLAG_BANNED if word in self.banwords else 0) | (FLAG_AUX if word in self.auxwords else 0))
+        return flags
+
+    def get_keysymbols(self, keys):
+        """Symbols of the keywords babble may pick, without and with the auxiliary ones, and the symbol each
+        keyword can start a reply with (None for auxiliary or unknown ones)"""
+        flags = self.get_flags()
+        lookup = self.dictionary.get_lookup()
+        plain, every, seeds = set(), set(), []
+        for word in keys:
+            symbol = lookup.get(word)
+            if symbol is not None:
+                every.add(symbol)
+                if flags[symbol] & FLAG_AUX:
+                    symbol = None
+                else:
+                    plain.add(symbol)
+            seeds.append(symbol)
+        return KeySymbols(plain, every, seeds)
 
     def make_keywords(self, words):
-        keys = Dictionary()
+        flags = self.get_flags()
+        lookup = self.dictionary.get_lookup()
+        keys, aux = [], []
+        seen = set()
         for word in words:
-            try:
-                word = self.swapwords[word]
-            except KeyError:
-                pass
-            if (self.dictionary.find_word(word) != self.error_symbol and word[0].isalnum() and
-                word not in self.banwords and word not in self.auxwords and word not in keys):
-                keys.append(word)
-
-        if keys:
-            for word in words:
-                try:
-                    word = self.swapwords[word]
-                except KeyError:
-                    pass
-                if (self.dictionary.find_word(word) != self.error_symbol and word[0].isalnum() and
-                    word in self.auxwords and word not in keys):
+            word = self.swapwords.get(word, word)
+            symbol = lookup.get(word, self.error_symbol)
+            if symbol != self.error_symbol and word[0].isalnum() and word not in seen:
+                if flags[symbol] & FLAG_AUX:
+                    seen.add(word)
+                    aux.append(word)
+                elif not flags[symbol] & FLAG_BANNED:
+                    seen.add(word)
                     keys.append(word)
-
+        # Auxiliary words only ever supplement other keywords
+        if keys:
+            keys.extend(aux)
         return keys
 
     def add_key(self, keys, word):
-        if (self.dictionary.find_word(word) != self.error_symbol and
-            self.banwords.find_word(word) == self.error_symbol and
-            self.auxwords.find_word(word) == self.error_symbol):
+        symbol = self.dictionary.find_word(word)
+        if symbol != self.error_symbol and not self.get_flags()[symbol] & (FLAG_BANNED | FLAG_AUX):
             keys.add_word(word)
 
+    def replay_journal(self):
+        """Relearn the phrases journaled after the last checkpoint that reached the brain file"""
+        checkpoint = self.db.get('checkpoint', 0)
+        journaled, entries = self.journal.read()
+        if journaled is not None and journaled >= checkpoint:
+            for words in entries:
+                self.learn(words)
+        else:
+            # Missing, or left over from a checkpoint that was saved but not yet truncated
+            self.journal.reset(checkpoint)
+
+    def checkpoint(self):
+        # What a snapshot brain learns is never saved anywhere but the journal, so it has no checkpoints
+        if self.journal is not None and self.store != 'snapshot':
+            self.db['checkpoint'] = self.db.get('checkpoint', 0) + 1
+            return self.db['checkpoint']
+
     def sync(self):
+        checkpoint = self.checkpoint()
         self.db.sync()
+        if checkpoint is not None:
+            self.journal.reset(checkpoint)
+        elif self.journal is not None:
+            self.journal.fsync()
 
     def close(self):
         if not self.closed:
             print('Closing database')
+            self.close_pool()
+            checkpoint = self.checkpoint()
             self.db.close()
+            if checkpoint is not None:
+                self.journal.reset(checkpoint)
+            elif self.journal is not None:
+                self.journal.close()
             self.closed = True
 
+    def export_snapshot(self, file):
+        """Write the brain, including anything learned on top of a snapshot, to a new snapshot file"""
+        meta = dict((key, self.db[key]) for key in ('api', 'order', 'banwords', 'auxwords', 'swapwords'))
+        meta['engine'] = 'tree'
+        Snapshot.write(file, {'forward': self.forward, 'backward': self.backward}, self.dictionary, meta)
+        if self.journal is not None and self.journal.file == file + '.journal':
+            # Overwrote the snapshot this brain came from, which now holds what the journal did
+            self.journal.reset(self.db.get('checkpoint', 0))
+
+    def import_snapshot(self, file):
+        """Replace the trees, dictionary and word lists with those of a snapshot"""
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        snapshot = Snapshot(file)
+        if snapshot.meta['order'] != self.order:
+            raise ValueError('This snapshot has an order of %d' % snapshot.meta['order'])
+        engine = ENGINES[self.db['engine']]
+        words = snapshot.words()
+        symbols = range(len(words))
+        self.forward = self.db['forward'] = prune_tree(snapshot.tree('forward'), 0, symbols, engine)
+        self.backward = self.db['backward'] = prune_tree(snapshot.tree('backward'), 0, symbols, engine)
+        self.dictionary = self.db['dictionary'] = Dictionary(words)
+        self.banwords = self.db['banwords'] = snapshot.meta['banwords']
+        self.auxwords = self.db['auxwords'] = snapshot.meta['auxwords']
+        self.swapwords = self.db['swapwords'] = snapshot.meta['swapwords']
+        self.close_pool()
+        self.learned = []
+        self.transitions.clear()
+
     def __del__(self):
         try:
             self.close()
@@ -427,16 +2074,119 @@ class Brain(object):
             pass
 
 
+# The brain a search worker process forked from, see Brain.get_pool
+search_brain = None
+
+
+def init_search_worker(brain):
+    global search_brain
+    search_brain = brain
+    # The parent process owns the brain file and the journal
+    brain.closed = True
+    brain.journal = None
+    brain.pool = None
+    brain.replayed = len(brain.learned)
+    random.seed()
+
+
+def search_in_worker(args):
+    keywords, candidates, deadline, timeout, keep, learned = args
+    brain = search_brain
+    # Catch up with what the parent learned since this worker was forked
+    for words in learned[brain.replayed:]:
+        brain.learn(words)
+    brain.replayed = len(learned)
+    brain.transitions.reset()
+    return brain.search(keywords, candidates, deadline, timeout, keep) + (brain.transitions.hits, brain.transitions.misses)
+
+
+def prune_walk(tree, threshold):
+    """Yield (node, kept) for each node of tree that pruning at threshold keeps, kept being its children that
+    stay too.  Children of the root always stay."""
+    queue = deque([tree])
+    while queue:
+        node = queue.popleft()
+        kept = [child for child in node.children if node is tree or child.count >= threshold]
+        yield node, kept
+        queue.extend(kept)
+
+
+def prune_tree(tree, threshold, symbols, engine=None):
+    """Copy tree (any engine, or into engine if given) without the nodes pruning at threshold drops, renumbering
+    each symbol s to symbols[s].  Each node's usage becomes the total count of the children it keeps."""
+    pruned = (engine or type(tree))()
+    copies = deque([pruned])
+    for node, kept in prune_walk(tree, threshold):
+        copy = copies.popleft()
+        copy.add_counts(node.count, sum(child.count for child in kept))
+        for child in kept:
+            copies.append(copy.get_child(symbols[child.symbol]))
+    return pruned
+
+
+def read_phrases(fp, end):
+    """Yield (offset, phrases) for each line of a binary file up to byte offset end, offset being where the next
+    line starts.  Carriage returns split a line the way text mode would; blank lines and comments are left out."""
+    offset = fp.tell()
+    while offset < end:
+        line = fp.readline()
+        if not line:
+            break
+        offset += len(line)
+        line = line.decode('utf-8')
+        if '\r' in line:
+            lines = line.replace('\r\n', '\n').split('\r')
+        else:
+            lines = [line]
+        phrases = []
+        for phrase in lines:
+            phrase = phrase.strip()
+            if phrase and not phrase.startswith('#'):
+                phrases.append(phrase)
+        yield offset, phrases
+
+
+def train_in_worker(args):
+    """Learn the lines between two byte offsets of a file into a scratch brain.
+
+    Returns its trees and words, with how many lines and tokens it learned.
+    """
+    file, start, end, order = args
+    brain = Brain(order, None, None, engine='tree', store='memory', journal=False)
+    lines = tokens = 0
+    with open(file, 'rb') as fp:
+        fp.seek(start)
+        for offset, phrases in read_phrases(fp, end):
+            lines += 1
+            for phrase in phrases:
+                words = brain.get_words_from_phrase(phrase)
+                brain.learn(words)
+                tokens += len(words)
+    brain.closed = True  # A scratch brain has nothing to save
+    # Trees learn faster, but ArrayTrees are much quicker to send back to the parent
+    return (ArrayTree.from_tree(brain.forward), ArrayTree.from_tree(brain.backward), list(brain.dictionary),
+            lines, tokens)
+
+
 class MegaHAL(object):
 
-    def __init__(self, order=None, brainfile=None, timeout=None):
+    def __init__(self, order=None, brainfile=None, timeout=None, engine=None, store=None, workers=None,
+                 candidates=None, surprise=None, deadline=None, readonly=False):
+        """Open the brain.  A reply search runs for timeout seconds, or through exactly candidates replies if
+        that is given; it stops early once a reply reaches the surprise score, and deadline (seconds) is a hard
+        limit on the whole reply.  A readonly brain is never written, not even a journal, and refuses to learn;
+        a brain file is read as it was last synced, and a snapshot is shared through the page cache with every
+        other process mapping it."""
         if order is None:
             order = DEFAULT_ORDER
         if brainfile is None:
             brainfile = DEFAULT_BRAINFILE
         if timeout is None:
             timeout = DEFAULT_TIMEOUT
-        self.__brain = Brain(order, brainfile, timeout)
+        if workers is None:
+            workers = DEFAULT_WORKERS
+        self.__brain = Brain(order, brainfile, timeout, engine, store, workers=workers,
+                             candidates=candidates, surprise=surprise, deadline=deadline, readonly=readonly)
 
     @property
     def banwords(self):
@@ -453,15 +2203,41 @@ class MegaHAL(object):
         """The word on the left is changed to the word on the right when used as a keyword"""
         return self.__brain.swapwords
 
-    def train(self, file):
-        """Train the brain with textfile, each line is a phrase"""
-        #with io.open("my_utf8_file.txt", "r", encoding="utf-8") as my_file:
-        #my_unicode_string = my_file.read() 
-        with io.open(file, 'r', encoding="utf-8") as fp:
-            for line in fp:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    self.learn(line)
+    @property
+    def last_search(self):
+        """How the last reply search went: candidates scored, best surprise, seconds taken and how often the
+        contexts it walked into were cached or not"""
+        return self.__brain.last_search
+
+    @property
+    def readonly(self):
+        """Whether the brain was opened read-only"""
+        return self.__brain.readonly
+
+    @property
+    def store(self):
+        """Name of the storage backend holding the brain: 'shelve', 'sqlite', 'snapshot' or 'memory'"""
+        return self.__brain.store
+
+    @property
+    def training(self):
+        """The file an interrupted training run stopped partway through, or None"""
+        record = self.__brain.db.get('training')
+        if record is not None:
+            return record['file']
+
+    def train(self, file, workers=None, checkpoint=None, progress=None):
+        """Train the brain with textfile, each line is a phrase.  With more than one worker (by default, the
+        brain's search workers) the file is learned in parallel chunks, giving the same brain.  The chunks take
+        more CPU time in all than learning the file in one go, and the merging is done here as they come back,
+        so this is only quicker with several idle cores.
+
+        The brain is saved every checkpoint lines, and training the same file again after an interruption
+        carries on from the last save.  progress is called with a TrainingProgress after each save."""
+        if checkpoint is None:
+            checkpoint = TRAIN_CHECKPOINT_LINES
+        self.__brain.train(file, workers, checkpoint, progress)
+        self.sync()
 
     def learn(self, phrase):
         """Learn from phrase"""
@@ -475,20 +2251,46 @@ class MegaHAL(object):
         """Get a reply without updating the database"""
         return self.__brain.communicate(phrase, learn=False)
 
-    def interact(self):
+    def get_replies(self, phrase, count, timeout=None, learn=True):
+        """Get up to count different replies to the phrase from one search, most surprising first.
+        timeout overrides the brain's search time for this call."""
+        return self.__brain.communicate(phrase, learn=learn, count=count, timeout=timeout)
+
+    def interact(self, stats=False):
         """Have a friendly chat session.. ^D to exit"""
         while True:
             try:
-                phrase = raw_input('>>> ')
+                phrase = input('>>> ')
             except EOFError:
                 break
             if phrase:
                 print(self.get_reply(phrase))
+                if stats:
+                    search = self.last_search
+                    sys.stderr.write('(%d candidates, best surprise %.3f, %.2fs, %d of %d contexts cached)\n' %
+                                     (search.candidates, search.surprise, search.elapsed, search.cache_hits,
+                                      search.cache_hits + search.cache_misses))
 
     def sync(self):
         """Flush any changes to disk"""
         self.__brain.sync()
 
+    def export_snapshot(self, file):
+        """Write the brain to a snapshot file, which opens (with store='snapshot', or detected) in milliseconds"""
+        self.__brain.export_snapshot(file)
+
+    def import_snapshot(self, file):
+        """Replace what the brain knows with the contents of a snapshot file"""
+        self.__brain.import_snapshot(file)
+        self.sync()
+
+    def compact(self, threshold=None):
+        """Prune contexts seen fewer than threshold times and rewrite the brain file, keeping every word.
+        Returns a Compaction with the node and word counts before and after."""
+        if threshold is None:
+            threshold = COMPACT_MIN_COUNT
+        return self.__brain.compact(threshold)
+
     def close(self):
         """Close database"""
         self.__brain.close()
@@ -0,0 +1,146 @@
+#coding=utf-8
+"""Rate limiting for the requests the bot sends to kbin.
+
+Each request takes a token from the bucket for its host and route class (page GETs, form POSTs and
+logins) before it goes out, so a cycle's handful of requests is sent straight away and only a steady
+stream gets slowed down.  A 429, or a 503 with Retry-After, holds back every request to that host for as
+long as the instance asks; GETs are then sent again, other requests are left to the caller to retry.
+"""
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+import threading
+
+import requests
+
+__all__ = ['DEFAULT_BUDGETS', 'RETRIES', 'told_to_back_off', 'TokenBucket', 'RateLimiter', 'RateLimitedSession']
+
+DEFAULT_BUDGETS = {  # Route class -> (requests per second, how many can go at once)
+    'page': (1.0, 5),
+    'form': (0.2, 2),
+    'login': (1 / 30, 2),
+}
+RETRY_AFTER_DEFAULT = 30.0  # Seconds to hold back after a 429 that doesn't say how long
+RETRY_AFTER_MAX = 900.0
+RETRIES = 2  # Times a GET is sent again after being told to back off
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, either a number of seconds or an HTTP date"""
+    if value is None:
+        return RETRY_AFTER_DEFAULT
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return RETRY_AFTER_DEFAULT
+    return min(max(seconds, 0.0), RETRY_AFTER_MAX)
+
+
+def told_to_back_off(status, headers):
+    """Whether a response with status and headers asks for requests to slow down"""
+    return status == 429 or (status == 503 and 'Retry-After' in headers)
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = monotonic()
+
+    def reserve(self, now):
+        """Take a token, return how many seconds it is until the token is really there"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter(object):
+
+    def __init__(self, budgets=None):
+        """budgets: route class -> (rate, burst), overriding DEFAULT_BUDGETS"""
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(budgets or {})
+        self.lock = threading.Lock()
+        self.buckets = {}  # (host, route class) -> TokenBucket
+        self.blocked = {}  # host -> monotonic time Retry-After lets requests go again
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_seconds = 0.0
+        self.retry_afters = 0
+
+    @staticmethod
+    def route(method, url):
+        if urlsplit(url).path.rstrip('/').endswith('/login'):
+            return 'login'
+        if method in ('GET', 'HEAD'):
+            return 'page'
+        return 'form'
+
+    def acquire(self, method, url):
+        """Wait until a request may be sent, return the seconds waited"""
+        wait = self.reserve(method, url)
+        if wait > 0:
+            sleep(wait)
+        return wait
+
+    def reserve(self, method, url):
+        """Book a request without waiting, return the seconds to wait before sending it"""
+        host = urlsplit(url).netloc
+        route = self.route(method, url)
+        with self.lock:
+            now = monotonic()
+            bucket = self.buckets.get((host, route))
+            if bucket is None:
+                bucket = self.buckets[(host, route)] = TokenBucket(*self.budgets[route])
+            wait = max(bucket.reserve(now), self.blocked.get(host, now) - now)
+            self.requests += 1
+            if wait > 0:
+                self.throttled += 1
+                self.throttled_seconds += wait
+        return wait
+
+    def back_off(self, url, retry_after=None):
+        """Hold back every request to url's host as a Retry-After header value asks, return the seconds"""
+        seconds = parse_retry_after(retry_after)
+        host = urlsplit(url).netloc
+        with self.lock:
+            self.retry_afters += 1
+            self.blocked[host] = max(self.blocked.get(host, 0.0), monotonic() + seconds)
+        return seconds
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+                'retry_afters': self.retry_afters
+            }
+
+
+class RateLimitedSession(requests.Session):
+    """requests.Session that waits on a RateLimiter before sending anything, redirects included"""
+
+    def __init__(self, limiter=None):
+        requests.Session.__init__(self)
+        self.limiter = limiter if limiter is not None else RateLimiter()
+
+    def send(self, request, **kwargs):
+        retries = RETRIES if request.method in ('GET', 'HEAD') else 0
+        while True:
+            self.limiter.acquire(request.method, request.url)
+            response = requests.Session.send(self, request, **kwargs)
+            if told_to_back_off(response.status_code, response.headers):
+                self.limiter.back_off(request.url, response.headers.get('Retry-After'))
+                if retries:
+                    retries -= 1
+                    response.close()
+                    continue
+            return response
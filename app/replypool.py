@@ -0,0 +1,126 @@
+#coding=utf-8
+"""Pool of replies searched for ahead of time, so posting doesn't wait on MegaHAL.
+
+A background thread fills a small queue of replies for each wanted prompt (the empty prompt, plus the
+prompts of threads replied to recently) while the bot is idle.  Queued replies are dropped once the
+brain has learned enough new phrases since they were made.  The brain isn't thread safe, so anything
+else using it while the pool runs should hold pool.lock.
+"""
+from collections import OrderedDict, deque
+from time import sleep
+import threading
+
+__all__ = ['ReplyPool']
+
+
+class ReplyPool(object):
+
+    def __init__(self, hal, depth=8, prompts=8, stale=32, timeout=None):
+        """depth: replies kept per prompt
+        prompts: recent prompts kept besides the empty one
+        stale: phrases learned before a queued reply is thrown away
+        timeout: search time for each refill, defaults to the brain's"""
+        self.hal = hal
+        self.depth = depth
+        self.prompts = prompts
+        self.stale = stale
+        self.timeout = timeout
+        self.lock = threading.RLock()
+        self.queues = OrderedDict([('', deque())])  # prompt -> deque of (generation, reply)
+        self.generation = 0  # Phrases learned so far
+        self.hits = 0
+        self.misses = 0
+        self.wake = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name='reply-pool', daemon=True)
+        self.thread.start()
+
+    def want(self, prompt):
+        """Keep replies to the prompt queued from now on"""
+        with self.lock:
+            if prompt in self.queues:
+                self.queues.move_to_end(prompt)
+            else:
+                self.queues[prompt] = deque()
+                while len(self.queues) > self.prompts + 1:
+                    for old in self.queues:
+                        if old:
+                            del self.queues[old]
+                            break
+        self.wake.set()
+
+    def learn(self, phrase):
+        with self.lock:
+            self.hal.learn(phrase)
+            self.generation += 1
+            self.evict()
+        self.wake.set()
+
+    def sync(self):
+        with self.lock:
+            self.hal.sync()
+
+    def compact(self, threshold=None):
+        with self.lock:
+            return self.hal.compact(threshold)
+
+    def get_replies(self, prompt, count, timeout=None, learn=True):
+        """Same as MegaHAL.get_replies, but served from the queue when it holds enough replies"""
+        with self.lock:
+            self.evict()
+            queue = self.queues.get(prompt)
+            if queue is not None and len(queue) >= count:
+                self.hits += 1
+                replies = [queue.popleft()[1] for i in range(count)]
+                if learn:
+                    self.hal.learn(prompt)
+            else:
+                self.misses += 1
+                replies = self.hal.get_replies(prompt, count, timeout, learn=learn)
+            if learn:
+                self.generation += 1
+        self.want(prompt)
+        return replies
+
+    def evict(self):
+        for queue in self.queues.values():
+            while queue and self.generation - queue[0][0] >= self.stale:
+                queue.popleft()
+
+    def stats(self):
+        with self.lock:
+            served = self.hits + self.misses
+            return {
+                'depth': sum(len(queue) for queue in self.queues.values()),
+                'prompts': len(self.queues),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / served if served else 0.0
+            }
+
+    def fill(self):
+        """Search once for the emptiest prompt, return False if there was nothing to add"""
+        with self.lock:
+            self.evict()
+            prompt, queue = min(self.queues.items(), key=lambda item: len(item[1]))
+            if len(queue) >= self.depth:
+                return False
+            replies = self.hal.get_replies(prompt, self.depth - len(queue), self.timeout, learn=False)
+            queued = len(queue)
+            for reply in replies:
+                if all(reply != other for generation, other in queue):
+                    queue.append((self.generation, reply))
+            return len(queue) > queued  # Nothing new means the brain is stuck, wait until it learns
+
+    def run(self):
+        while not self.stopped:
+            if self.fill():
+                sleep(0.01)  # Let whoever is waiting on the lock have it
+            else:
+                self.wake.wait()
+                self.wake.clear()
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""Time training a file line by line and in parallel chunks, for each engine.
+
+Not collected by pytest, run it by hand:  python tests/bench_train.py [-w 4] [file]
+Without a file a random one is written first.  The brains are kept in memory, so only learning and merging are
+timed, and each parallel brain is checked against the sequential one.  Merging happens in this process while the
+workers learn, so the time it takes is also shown: however many CPUs there are, a parallel run can't take less.
+"""
+from optparse import OptionParser
+import os
+import random
+import sys
+import tempfile
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+from megahal import Brain, DEFAULT_ORDER
+
+
+def write_corpus(file, lines, seed=0):
+    rng = random.Random(seed)
+    vocabulary = ['w%d' % i for i in range(5000)]
+    with open(file, 'w') as fp:
+        for i in range(lines):
+            # Zipf-ish, so common contexts repeat across chunks the way they do in real text
+            fp.write(' '.join(vocabulary[int(rng.paretovariate(1.1)) % len(vocabulary)]
+                              for j in range(rng.randint(3, 20))) + '.\n')
+
+
+def walk(tree):
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        children = list(node.children)
+        nodes.append((node.symbol, node.count, node.usage, len(children)))
+        stack.extend(reversed(children))
+    return nodes
+
+
+def train(file, engine, workers):
+    merging = [0.0]
+    merge = Brain.merge
+
+    def timed_merge(self, *args):
+        basetime = time()
+        merge(self, *args)
+        merging[0] += time() - basetime
+
+    Brain.merge = timed_merge
+    try:
+        brain = Brain(DEFAULT_ORDER, None, None, engine=engine, store='memory', journal=False)
+        basetime = time()
+        brain.train(file, workers=workers)
+        elapsed = time() - basetime
+    finally:
+        Brain.merge = merge
+    trained = walk(brain.forward), walk(brain.backward), list(brain.dictionary)
+    brain.closed = True
+    return elapsed, merging[0], trained
+
+
+def main(argv=None):
+    optparse = OptionParser(usage='%prog [options] [file]', description=__doc__)
+    optparse.add_option('-w', '--workers', metavar='<int>', default=4, type='int',
+                        help='processes for the parallel runs (default: %default)')
+    optparse.add_option('-l', '--lines', metavar='<int>', default=50000, type='int',
+                        help='lines in the random file (default: %default)')
+    opts, args = optparse.parse_args(argv)
+    if args:
+        file = args[0]
+    else:
+        file = os.path.join(tempfile.mkdtemp(), 'corpus.txt')
+        write_corpus(file, opts.lines)
+    print('%d CPUs, %d workers, %s (%d bytes)' % (os.cpu_count(), opts.workers, file, os.path.getsize(file)))
+    for engine in ('tree', 'array'):
+        sequential, merging, expected = train(file, engine, 1)
+        parallel, merging, trained = train(file, engine, opts.workers)
+        print('%-5s  1 worker %6.2fs  %d workers %6.2fs (merging %.2fs)  speedup %.2fx%s' % (
+            engine, sequential, opts.workers, parallel, merging, sequential / parallel,
+            '' if trained == expected else '  DIFFERENT BRAIN'))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
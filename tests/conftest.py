@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The bot runs from app/ and imports its modules by their plain names, do the same here
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
@@ -0,0 +1,89 @@
+#coding=utf-8
+"""The asyncio kbin client against a stub kbin instance"""
+import asyncio
+
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from kbinclient import KbinClient
+from ratelimit import RateLimiter
+
+THREAD_PAGE = ('<meta property="og:title" content="Thread %s - CHATBOT THUNDERDOME - kbin.social">\n'
+               '<meta property="og:description" content="About %s">\n'
+               '<input type="hidden" id="entry_comment__token" name="entry_comment[_token]" value="token%s">')
+
+
+def stub_instance(requests, missing=()):
+    """A kbin that serves threads to whoever holds the session cookie, and 404s the missing ones"""
+
+    async def login_page(request):
+        requests.append('GET /login')
+        return web.Response(text='<input type="hidden" name="_csrf_token" value="login">')
+
+    async def login(request):
+        requests.append('POST /login')
+        response = web.Response(text='logged in')
+        response.set_cookie('session', 'good')
+        return response
+
+    async def thread(request):
+        id = request.match_info['id']
+        if request.cookies.get('session') != 'good':
+            raise web.HTTPFound('/login')
+        if int(id) in missing:
+            raise web.HTTPNotFound()
+        return web.Response(text=THREAD_PAGE % (id, id, id))
+
+    async def comment(request):
+        id = request.match_info['id']
+        form = await request.post()
+        if request.cookies.get('session') != 'good':
+            raise web.HTTPFound('/login')
+        requests.append('comment %s %s' % (id, form['entry_comment[body]']))
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.add_routes([web.get('/login', login_page), web.post('/login', login),
+                    web.get('/m/{magazine}/t/{id}', thread), web.post('/m/{magazine}/t/{id}/-/comment', comment)])
+    return app
+
+
+def post_replies(cookies, missing=()):
+    requests = []
+
+    async def run():
+        async with TestServer(stub_instance(requests, missing), host='127.0.0.1') as server:
+            limiter = RateLimiter({'page': (1000, 100), 'form': (1000, 100), 'login': (1000, 100)})
+            async with KbinClient('127.0.0.1:%d' % server.port, 'user', 'password', 'en', limiter, cookies=cookies,
+                                  scheme='http') as client:
+                replies = await client.post_replies('random', [1, 2, 3], lambda prompt: 'Re: ' + prompt)
+                return replies, client.logins, client.get_cookies()
+
+    replies, logins, client_cookies = asyncio.run(run())
+    return replies, logins, client_cookies, requests
+
+
+def test_missing_thread_keeps_session():
+    replies, logins, cookies, requests = post_replies({'session': 'good'}, missing=[2])
+    assert replies == {1: True, 2: False, 3: True}
+    assert logins == 0
+    assert not any('login' in request for request in requests)
+
+
+def test_stale_session_logs_in_once():
+    replies, logins, cookies, requests = post_replies({'session': 'stale'})
+    assert replies == {1: True, 2: True, 3: True}
+    assert logins == 1
+    assert requests.count('POST /login') == 1
+    assert sorted(request for request in requests if request.startswith('comment')) == [
+        'comment 1 Re: Thread 1 About 1', 'comment 2 Re: Thread 2 About 2', 'comment 3 Re: Thread 3 About 3']
+    assert [(name, value) for name, value, domain, path in cookies] == [('session', 'good')]
+
+
+def test_no_session_logs_in():
+    replies, logins, cookies, requests = post_replies(None)
+    assert replies == {1: True, 2: True, 3: True}
+    assert logins == 1
@@ -0,0 +1,119 @@
+#coding=utf-8
+"""Brain.get_words_from_phrase against the boundary()-scanning tokenizer it replaced"""
+import random
+
+import pytest
+import regex as re
+
+from megahal import Brain
+
+LETTERS = re.compile(r"([\p{L}]+)", re.UNICODE)
+
+
+def reference_words(phrase):
+    """The tokenizer before WORD_REGEX, kept as it was apart from hoisting the letter pattern"""
+    phrase = phrase.upper()
+    words = []
+    if phrase:
+        offset = 0
+
+        def isalpha_extended(str):
+            return str.isalpha() or LETTERS.search(str) is not None
+
+        def boundary(string, position):
+            if position == 0:
+                boundary = False
+            elif position == len(string):
+                boundary = True
+            elif (string[position] == "'" and
+                isalpha_extended(string[position - 1]) and
+                isalpha_extended(string[position + 1])):
+                boundary = False
+            elif (position > 1 and
+                string[position - 1] == "'" and
+                isalpha_extended(string[position - 2]) and
+                isalpha_extended(string[position])):
+                boundary = False
+            elif (isalpha_extended(string[position]) and
+                not isalpha_extended(string[position - 1])):
+                boundary = True
+            elif (not isalpha_extended(string[position]) and
+                isalpha_extended(string[position - 1])):
+                boundary = True
+            elif string[position].isdigit() != string[position -1].isdigit():
+                boundary = True
+            else:
+                boundary = False
+            return boundary
+
+        colon = False
+
+        while True:
+            if offset < len(phrase) and phrase[offset] == ":":
+                colon = True
+            elif offset > 0 and phrase[offset-1] == ":" and not isalpha_extended(phrase[offset]):
+                colon = False
+            if boundary(phrase, offset):
+                word, phrase = phrase[:offset], phrase[offset:]
+                words.append(word)
+                if not phrase:
+                    break
+                offset = 0
+            else:
+                offset += 1
+        if words[-1][0].isalnum():
+            words.append('.')
+        elif words[-1][-1] == ':' and colon:
+            words[-1] = ':'
+        elif words[-1][-1] not in '!.?':
+            words[-1] = '.'
+    return words
+
+
+@pytest.mark.parametrize('phrase', [
+    # Apostrophes join letters only
+    "don't", "it's", "rock 'n' roll", "o'neil's", "can''t", "a ' b", "rock'n'roll",
+    # Digits and letters split from each other
+    "abc123def", "2nd place", "route 66", "1,000,000", "½ and ²", "٣ apples",
+    # Colons inside a phrase
+    ":smile: hi", "a :b: c", "a::b", ":)", "ratio 3:2", "time: 12:30",
+    # Final punctuation
+    "why?!", "wow!!!", "ok...", "hello, world", "hi -", "x", "", " ", "trailing space ",
+    # Beyond ASCII
+    "é日本 ΩЖ", "STRASSE straße", "ǅungla", "emoji 😀 here", "tab\there",
+])
+def test_matches_reference(phrase):
+    assert Brain.get_words_from_phrase(phrase) == reference_words(phrase)
+
+
+@pytest.mark.parametrize('phrase, words', [
+    # Apostrophe at the end
+    ("don'", ['DON', '.']),
+    ("the dogs'", ['THE', ' ', 'DOGS', '.']),
+    ("'quoted'", ["'", 'QUOTED', '.']),
+    # Colon at the end, kept after an emote and otherwise replaced by a period
+    (":smile:", [':', 'SMILE', ':']),
+    ("hello :smile:", ['HELLO', ' :', 'SMILE', ':']),
+    ("end:x:", ['END', ':', 'X', ':']),
+    ("note:", ['NOTE', '.']),
+])
+def test_used_to_raise(phrase, words):
+    # The old tokenizer looked past the end of these and raised IndexError
+    with pytest.raises(IndexError):
+        reference_words(phrase)
+    assert Brain.get_words_from_phrase(phrase) == words
+
+
+def test_random_phrases():
+    alphabet = list("abcXYZ'':: .,!?-_12390²³½éÜßñ日本語ЖжΩ😀\t\n#@̀ǅ٣")
+    rng = random.Random(0)
+    compared = 0
+    for i in range(20000):
+        phrase = ''.join(rng.choice(alphabet) for j in range(rng.randint(0, 14)))
+        try:
+            expected = reference_words(phrase)
+        except IndexError:
+            continue
+        assert Brain.get_words_from_phrase(phrase) == expected, phrase
+        compared += 1
+    assert compared > 15000
@@ -0,0 +1,76 @@
+#coding=utf-8
+"""Training in parallel chunks gives the same brain as training line by line"""
+import multiprocessing
+import random
+
+import pytest
+
+from megahal import MegaHAL
+
+WORDS = ("the cat dog sat on a mat ran away from home it's don't big small red blue one two 3 42 "
+         "hello there friend how are you :smile: why what when where yes no").split()
+
+
+@pytest.fixture
+def trainer(tmp_path):
+    rng = random.Random(0)
+    lines = []
+    for i in range(600):
+        lines.append(' '.join(rng.choice(WORDS) for j in range(rng.randint(1, 12))) + rng.choice(['', '.', '!', '?']))
+        if i % 50 == 0:
+            lines.append('# a comment')
+        if i % 70 == 0:
+            lines.append('')
+    file = tmp_path / 'trainer.txt'
+    file.write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return str(file)
+
+
+def walk(tree):
+    """(symbol, count, usage, children) of every node, depth first"""
+    nodes = []
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        children = list(node.children)
+        nodes.append((node.symbol, node.count, node.usage, len(children)))
+        stack.extend(reversed(children))
+    return nodes
+
+
+def train(brainfile, file, engine, workers):
+    hal = MegaHAL(brainfile=str(brainfile), engine=engine)
+    hal.train(file, workers=workers)
+    brain = hal._MegaHAL__brain
+    trained = walk(brain.forward), walk(brain.backward), list(brain.dictionary)
+    hal.close()
+    return trained
+
+
+@pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='needs the fork start method')
+@pytest.mark.parametrize('engine', ['tree', 'array'])
+def test_parallel_matches_sequential(tmp_path, trainer, engine):
+    forward, backward, dictionary = train(tmp_path / 'sequential', trainer, engine, 1)
+    assert len(forward) > 1000
+    assert (forward, backward, dictionary) == train(tmp_path / 'parallel', trainer, engine, 3)
+
+
+@pytest.mark.parametrize('store', ['shelve', 'sqlite'])
+def test_resume_after_error(tmp_path, trainer, store):
+    # A line that isn't UTF-8 stops training partway, past the last checkpoint
+    with open(trainer, 'rb') as fp:
+        lines = fp.read().split(b'\n')
+    broken = tmp_path / 'broken.txt'
+    broken.write_bytes(b'\n'.join(lines[:450] + [b'\xff\xfe'] + lines[450:]))
+    hal = MegaHAL(brainfile=str(tmp_path / 'resumed'), store=store)
+    with pytest.raises(UnicodeDecodeError):
+        hal.train(str(broken), workers=1, checkpoint=100)
+    hal.close()
+    # Mended in place, training again carries on from the line that failed
+    broken.write_bytes(b'\n'.join(lines[:450] + [b'ok'] + lines[450:]))
+    mended = tmp_path / 'mended.txt'
+    mended.write_bytes(broken.read_bytes())
+    hal = MegaHAL(brainfile=str(tmp_path / 'resumed'), store=store)
+    assert hal.training == str(broken)
+    hal.close()
+    assert train(tmp_path / 'resumed', str(broken), None, 1) == train(tmp_path / 'clean', str(mended), None, 1)